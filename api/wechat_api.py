@@ -1,5 +1,8 @@
 import asyncio
-from typing import Any, Dict, Optional, Union
+import json
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
 import aiohttp
 import requests
@@ -96,6 +99,388 @@ def _resolve_api_path(api_path: str) -> Optional[str]:
         return resolved_path
 
 
+class TokenBucket:
+    """令牌桶：按固定速率补充令牌，最多允许 burst 个突发请求"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """预占一个令牌，返回拿到令牌前需要等待的秒数（令牌不足时记为欠账，保证先到先得）"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def refund(self):
+        """归还一个未使用的令牌（等待被取消时调用）"""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + 1)
+
+
+def _make_bucket(limit) -> Optional[TokenBucket]:
+    if limit is None or limit.rate <= 0:
+        return None
+    return TokenBucket(limit.rate, limit.burst)
+
+
+class RateLimiter:
+    """网关限流器：每个接口一个令牌桶，外加一个全局令牌桶
+
+    令牌桶的状态由线程锁保护，等待在各自的事件循环中进行，
+    因此HTTP回调线程和消息处理线程可以共享同一个限流器。
+    """
+
+    def __init__(self):
+        self._cfg = None
+        self._total: Optional[TokenBucket] = None
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """配置文件重新加载后重建令牌桶"""
+        cfg = config.cfg.ratelimit
+        if cfg is self._cfg:
+            return
+
+        with self._lock:
+            if cfg is self._cfg:
+                return
+
+            buckets = {}
+            for name, limit in cfg.endpoints.items():
+                path = WeChatAPIPaths.get_path(name)
+                bucket = _make_bucket(limit)
+                if path and bucket:
+                    buckets[path] = bucket
+
+            self._total = _make_bucket(cfg.total)
+            self._buckets = buckets
+            self._cfg = cfg
+            logger.debug(f"限流配置已加载: 全局={cfg.total}, 接口数={len(buckets)}")
+
+    def _reserve(self, resolved_path: str) -> Tuple[float, List[TokenBucket]]:
+        """同时从接口令牌桶和全局令牌桶预占令牌，返回需要等待的时间"""
+        self._refresh()
+        if not self._cfg.enable:
+            return 0.0, []
+
+        buckets = [b for b in (self._buckets.get(resolved_path), self._total) if b is not None]
+        delay = max([b.reserve() for b in buckets], default=0.0)
+        return delay, buckets
+
+    async def acquire(self, resolved_path: str):
+        """异步等待令牌"""
+        delay, buckets = self._reserve(resolved_path)
+        if delay <= 0:
+            return
+
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            for bucket in buckets:
+                bucket.refund()
+            raise
+
+    def acquire_sync(self, resolved_path: str):
+        """同步等待令牌"""
+        delay, _ = self._reserve(resolved_path)
+        if delay > 0:
+            time.sleep(delay)
+
+
+# 全局限流器
+rate_limiter = RateLimiter()
+
+
+# 延迟直方图各个桶的上限（毫秒），最后一个桶为 +Inf
+_LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class EndpointStats:
+    """单个接口的调用统计"""
+
+    def __init__(self):
+        self.calls = 0
+        self.inflight = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.status: Dict[int, int] = {}
+        self.buckets = [0] * (len(_LATENCY_BUCKETS_MS) + 1)
+        self.latency_sum_ms = 0.0
+        self.latency_max_ms = 0.0
+
+    def percentile(self, q: float) -> float:
+        """根据直方图估算分位数（毫秒），在桶内做线性插值"""
+        total = sum(self.buckets)
+        if total == 0:
+            return 0.0
+
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for i, count in enumerate(self.buckets):
+            upper = _LATENCY_BUCKETS_MS[i] if i < len(_LATENCY_BUCKETS_MS) else self.latency_max_ms
+            if count and seen + count >= rank:
+                return min(lower + (upper - lower) * (rank - seen) / count, self.latency_max_ms)
+            seen += count
+            lower = upper
+        return self.latency_max_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        finished = sum(self.buckets)
+        return {
+            "calls": self.calls,
+            "inflight": self.inflight,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "status": dict(self.status),
+            "latency_avg_ms": round(self.latency_sum_ms / finished, 2) if finished else 0.0,
+            "latency_max_ms": round(self.latency_max_ms, 2),
+            "latency_p50_ms": round(self.percentile(0.5), 2),
+            "latency_p90_ms": round(self.percentile(0.9), 2),
+            "latency_p99_ms": round(self.percentile(0.99), 2),
+        }
+
+
+class ApiMetrics:
+    """网关调用统计：按解析后的接口路径统计调用次数、进行中数量、状态码、错误、超时和延迟分布"""
+
+    def __init__(self):
+        self._stats: Dict[str, EndpointStats] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, resolved_path: str) -> EndpointStats:
+        stats = self._stats.get(resolved_path)
+        if stats is None:
+            stats = self._stats[resolved_path] = EndpointStats()
+        return stats
+
+    def start(self, resolved_path: str) -> float:
+        """记录一次调用开始，返回开始时间"""
+        with self._lock:
+            stats = self._get(resolved_path)
+            stats.calls += 1
+            stats.inflight += 1
+        return time.monotonic()
+
+    def finish(self, resolved_path: str, started: float, status: Optional[int] = None, outcome: str = "ok"):
+        """
+        记录一次调用结束
+
+        Args:
+            resolved_path: 接口路径
+            started: start() 返回的开始时间
+            status: HTTP状态码，未收到响应时为None
+            outcome: ok / error / timeout
+        """
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            stats = self._get(resolved_path)
+            stats.inflight -= 1
+            if status is not None:
+                stats.status[status] = stats.status.get(status, 0) + 1
+            if outcome == "timeout":
+                stats.timeouts += 1
+            elif outcome != "ok":
+                stats.errors += 1
+
+            index = len(_LATENCY_BUCKETS_MS)
+            for i, bound in enumerate(_LATENCY_BUCKETS_MS):
+                if elapsed_ms <= bound:
+                    index = i
+                    break
+            stats.buckets[index] += 1
+            stats.latency_sum_ms += elapsed_ms
+            stats.latency_max_ms = max(stats.latency_max_ms, elapsed_ms)
+
+        slow_call_ms = config.cfg.metrics.slow_call_ms
+        if 0 < slow_call_ms <= elapsed_ms:
+            logger.warning(f"慢调用 [{resolved_path}] 耗时 {elapsed_ms:.0f}ms, 结果: {outcome}, 状态码: {status}")
+
+    def percentile(self, resolved_path: str, q: float) -> float:
+        """获取某个接口的延迟分位数（毫秒）"""
+        with self._lock:
+            stats = self._stats.get(resolved_path)
+            return stats.percentile(q) if stats else 0.0
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """获取所有接口的统计数据"""
+        with self._lock:
+            return {path: stats.to_dict() for path, stats in self._stats.items()}
+
+    def export_prometheus(self) -> str:
+        """以Prometheus文本格式导出统计数据，同一指标的数据放在一起，紧跟在其TYPE行之后"""
+        with self._lock:
+            items = [(f'path="{path}"', stats) for path, stats in sorted(self._stats.items())]
+
+            lines = ["# TYPE wechat_api_calls_total counter"]
+            lines.extend(f"wechat_api_calls_total{{{label}}} {stats.calls}" for label, stats in items)
+            lines.append("# TYPE wechat_api_inflight gauge")
+            lines.extend(f"wechat_api_inflight{{{label}}} {stats.inflight}" for label, stats in items)
+            lines.append("# TYPE wechat_api_errors_total counter")
+            lines.extend(f"wechat_api_errors_total{{{label}}} {stats.errors}" for label, stats in items)
+            lines.append("# TYPE wechat_api_timeouts_total counter")
+            lines.extend(f"wechat_api_timeouts_total{{{label}}} {stats.timeouts}" for label, stats in items)
+
+            lines.append("# TYPE wechat_api_responses_total counter")
+            for label, stats in items:
+                for status, count in sorted(stats.status.items()):
+                    lines.append(f'wechat_api_responses_total{{{label},status="{status}"}} {count}')
+
+            lines.append("# TYPE wechat_api_latency_ms histogram")
+            for label, stats in items:
+                cumulative = 0
+                for i, count in enumerate(stats.buckets):
+                    cumulative += count
+                    le = _LATENCY_BUCKETS_MS[i] if i < len(_LATENCY_BUCKETS_MS) else "+Inf"
+                    lines.append(f'wechat_api_latency_ms_bucket{{{label},le="{le}"}} {cumulative}')
+                lines.append(f"wechat_api_latency_ms_sum{{{label}}} {stats.latency_sum_ms:.3f}")
+                lines.append(f"wechat_api_latency_ms_count{{{label}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+# 全局调用统计
+api_metrics = ApiMetrics()
+
+
+def get_api_metrics() -> Dict[str, Dict[str, Any]]:
+    """获取网关调用统计"""
+    return api_metrics.snapshot()
+
+
+# 只读接口：相同参数的并发请求可以安全地共享同一次调用
+_COALESCE_PATHS = frozenset({
+    WeChatAPIPaths.GET_PROFILE,
+    WeChatAPIPaths.AUTO_HEART_BEAT_LOG,
+    WeChatAPIPaths.USER_INFO,
+    WeChatAPIPaths.USER_LIST,
+    WeChatAPIPaths.USER_SEARCH,
+    WeChatAPIPaths.WECOM_SEARCH,
+    WeChatAPIPaths.GROUP_MEMBER,
+    WeChatAPIPaths.GET_IMAGE_CDN,
+    WeChatAPIPaths.GET_IMAGE,
+    WeChatAPIPaths.GET_VIDEO,
+    WeChatAPIPaths.GET_FILE,
+    WeChatAPIPaths.GET_EMOJI,
+    WeChatAPIPaths.GET_VOICE,
+})
+
+
+class SingleFlight:
+    """请求合并：同一事件循环中参数相同的并发请求共享同一个进行中的调用"""
+
+    def __init__(self):
+        self._inflight: Dict[tuple, asyncio.Task] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(resolved_path: str, body: Optional[Dict[str, Any]], query_params: Optional[Dict[str, Any]]) -> tuple:
+        """以 (接口路径, 规范化的请求体, 规范化的查询参数) 作为合并键"""
+        return (
+            resolved_path,
+            json.dumps(body, sort_keys=True, ensure_ascii=False, default=str),
+            json.dumps(query_params, sort_keys=True, ensure_ascii=False, default=str),
+        )
+
+    def _count(self, resolved_path: str, coalesced: bool):
+        with self._lock:
+            stats = self._stats.setdefault(resolved_path, {"calls": 0, "coalesced": 0})
+            stats["calls"] += 1
+            if coalesced:
+                stats["coalesced"] += 1
+
+    async def do(self, key: tuple, func: Callable[[], Awaitable[Any]]) -> Any:
+        """执行func，若已有相同键的调用在进行中则等待其结果"""
+        loop = asyncio.get_running_loop()
+        # Task只能在创建它的事件循环中等待，因此按事件循环区分
+        flight_key = (id(loop),) + key
+
+        task = self._inflight.get(flight_key)
+        coalesced = task is not None
+        if not coalesced:
+            task = loop.create_task(func())
+            self._inflight[flight_key] = task
+
+            def _done(t, k=flight_key):
+                if self._inflight.get(k) is t:
+                    del self._inflight[k]
+
+            task.add_done_callback(_done)
+
+        self._count(key[0], coalesced)
+
+        # 使用shield，避免某个调用方被取消时影响其它共享结果的调用方
+        return await asyncio.shield(task)
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """获取各接口的调用次数、被合并次数和当前进行中的调用数"""
+        with self._lock:
+            stats = {path: dict(counts, inflight=0) for path, counts in self._stats.items()}
+        for key in list(self._inflight):
+            path = key[1]
+            if path in stats:
+                stats[path]["inflight"] += 1
+        return stats
+
+
+# 全局请求合并器
+single_flight = SingleFlight()
+
+
+def get_coalesce_stats() -> Dict[str, Dict[str, int]]:
+    """获取请求合并统计"""
+    return single_flight.get_stats()
+
+
+# 每个事件循环复用一个ClientSession，以复用连接: {id(loop): (loop, session, uds_path)}
+_sessions: Dict[int, Tuple[asyncio.AbstractEventLoop, aiohttp.ClientSession, str]] = {}
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    """获取当前事件循环的ClientSession，配置了uds_path时通过Unix域套接字连接网关"""
+    loop = asyncio.get_running_loop()
+    uds_path = config.cfg.service.uds_path
+
+    cached = _sessions.get(id(loop))
+    if cached is not None:
+        cached_loop, session, cached_uds = cached
+        if cached_loop is loop and not session.closed and cached_uds == uds_path:
+            return session
+        # 配置变更后重建连接；其它（已结束的）事件循环留下的会话不能在当前循环中关闭，直接丢弃
+        if cached_loop is loop:
+            await session.close()
+
+    if uds_path:
+        connector = aiohttp.UnixConnector(path=uds_path)
+        logger.info(f"通过Unix域套接字连接网关: {uds_path}")
+    else:
+        connector = aiohttp.TCPConnector()
+
+    session = aiohttp.ClientSession(connector=connector)
+    _sessions[id(loop)] = (loop, session, uds_path)
+    return session
+
+
+async def close_session():
+    """关闭当前事件循环的ClientSession，在事件循环结束前调用"""
+    loop = asyncio.get_running_loop()
+    cached = _sessions.get(id(loop))
+    if cached is None or cached[0] is not loop:
+        return
+    del _sessions[id(loop)]
+    await cached[1].close()
+
+
 async def wechat_api(
         api_path: str,
         body: Optional[Dict[str, Any]] = None,
@@ -104,7 +489,9 @@ async def wechat_api(
 ) -> Union[Dict[str, Any], bool]:
     """
     异步微信API调用函数
-    
+
+    只读接口的相同并发请求会被合并为一次网关调用，调用方共享同一个响应对象，不应修改它。
+
     Args:
         api_path: API路径或路径名称（如 'get_profile' 或 '/User/GetContractProfile'）
         body: 请求体数据
@@ -119,26 +506,54 @@ async def wechat_api(
     if resolved_path is None:
         return False
 
+    if resolved_path in _COALESCE_PATHS:
+        key = single_flight.make_key(resolved_path, body, query_params)
+        return await single_flight.do(
+            key, lambda: _post(api_path, resolved_path, body, query_params, timeout)
+        )
+
+    return await _post(api_path, resolved_path, body, query_params, timeout)
+
+
+async def _post(
+        api_path: str,
+        resolved_path: str,
+        body: Optional[Dict[str, Any]],
+        query_params: Optional[Dict[str, Any]],
+        timeout: int
+) -> Union[Dict[str, Any], bool]:
+    """实际发起网关请求"""
+    # 等待限流令牌
+    await rate_limiter.acquire(resolved_path)
+
     api_url = f"{config.BASE_URL}{resolved_path}"
 
+    started = api_metrics.start(resolved_path)
+    status = None
+    outcome = "error"
     try:
         # 设置超时时间
         client_timeout = aiohttp.ClientTimeout(total=timeout)
 
-        async with aiohttp.ClientSession(timeout=client_timeout) as session:
-            async with session.post(
-                    url=api_url,
-                    json=body,
-                    params=query_params
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    response_text = await response.text()
-                    logger.error(f"API调用失败 [{api_path}]，状态码: {response.status}, 响应: {response_text}")
-                    return False
+        session = await _get_session()
+        async with session.post(
+                url=api_url,
+                json=body,
+                params=query_params,
+                timeout=client_timeout
+        ) as response:
+            status = response.status
+            if response.status == 200:
+                result = await response.json()
+                outcome = "ok"
+                return result
+            else:
+                response_text = await response.text()
+                logger.error(f"API调用失败 [{api_path}]，状态码: {response.status}, 响应: {response_text}")
+                return False
 
     except asyncio.TimeoutError:
+        outcome = "timeout"
         logger.error(f"API调用超时 [{api_path}]: {api_url}")
         return False
     except aiohttp.ClientError as e:
@@ -147,6 +562,8 @@ async def wechat_api(
     except Exception as e:
         logger.error(f"调用微信API时出错 [{api_path}]: {e}")
         return False
+    finally:
+        api_metrics.finish(resolved_path, started, status, outcome)
 
 
 def wechat_api_sync(
@@ -156,7 +573,7 @@ def wechat_api_sync(
         timeout: int = 30
 ) -> Union[Dict[str, Any], bool]:
     """
-    同步微信API调用函数
+    同步微信API调用函数（始终通过TCP连接网关）
     
     Args:
         api_path: API路径或路径名称
@@ -172,8 +589,14 @@ def wechat_api_sync(
     if resolved_path is None:
         return False
 
+    # 等待限流令牌
+    rate_limiter.acquire_sync(resolved_path)
+
     api_url = f"{config.BASE_URL}{resolved_path}"
 
+    started = api_metrics.start(resolved_path)
+    status = None
+    outcome = "error"
     try:
         response = requests.post(
             url=api_url,
@@ -182,13 +605,17 @@ def wechat_api_sync(
             timeout=timeout
         )
 
+        status = response.status_code
         if response.status_code == 200:
-            return response.json()
+            result = response.json()
+            outcome = "ok"
+            return result
         else:
             logger.error(f"API调用失败 [{api_path}]，状态码: {response.status_code}, 响应: {response.text}")
             return False
 
     except requests.exceptions.Timeout:
+        outcome = "timeout"
         logger.error(f"API调用超时 [{api_path}]: {api_url}")
         return False
     except requests.exceptions.RequestException as e:
@@ -197,6 +624,8 @@ def wechat_api_sync(
     except Exception as e:
         logger.error(f"调用微信API时出错 [{api_path}]: {e}")
         return False
+    finally:
+        api_metrics.finish(resolved_path, started, status, outcome)
 
 
 async def _send_telegram_text(to_wxid: str, text: str) -> bool:
@@ -1,7 +1,17 @@
+import asyncio
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
 from loguru import logger
 
 import config
 from api.wechat_api import wechat_api
+from utils.fileutil import atomic_write
 
 
 # 获取用户信息
@@ -42,16 +52,25 @@ async def get_user_info(towxids):
     result = await wechat_api("USER_INFO", body)
 
     # 解析响应
-    if result.get("Success"):
+    if result and result.get("Success"):
         try:
             contact_list = result["Data"]["ContactList"]
             if contact_list and len(contact_list) > 0:
                 if is_batch:
+                    # 优先按UserName对应，避免返回顺序与请求顺序不一致
+                    contact_by_wxid = {}
+                    for contact in contact_list:
+                        username = (contact.get("UserName") or {}).get("string")
+                        if username:
+                            contact_by_wxid[username] = contact
+
                     # 批量查询：返回字典，key为wxid，value为UserInfo
                     user_info_dict = {}
                     for i, wxid in enumerate(wxid_list):
-                        if i < len(contact_list):
+                        contact = contact_by_wxid.get(wxid)
+                        if contact is None and not contact_by_wxid and i < len(contact_list):
                             contact = contact_list[i]
+                        if contact is not None:
                             name = (contact.get("Remark", {}).get("string") or
                                     contact.get("NickName", {}).get("string") or
                                     f"微信_{wxid}")
@@ -60,7 +79,7 @@ async def get_user_info(towxids):
                                           "")
                             user_info_dict[wxid] = UserInfo(name, avatar_url)
                         else:
-                            # 如果contact_list长度不够，填充None
+                            # 如果未返回该联系人，填充None
                             user_info_dict[wxid] = None
                     return user_info_dict
                 else:
@@ -76,7 +95,7 @@ async def get_user_info(towxids):
         except (KeyError, IndexError) as e:
             logger.error(f"解析联系人信息时出错: {str(e)}")
     else:
-        error_msg = result.get('Message', '未知错误')
+        error_msg = result.get('Message', '未知错误') if result else '请求失败'
         logger.error(f"API请求失败: {error_msg}")
 
     # 返回对应的None值
@@ -86,16 +105,183 @@ async def get_user_info(towxids):
         return None
 
 
+class _PendingBatch:
+    """等待发送的一批用户信息查询"""
+
+    def __init__(self):
+        self.futures: Dict[str, List[asyncio.Future]] = {}
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+
+class UserInfoLoader:
+    """用户信息批量加载器
+
+    在 wait 秒的窗口内收集单个 wxid 的查询，合并为一次 USER_INFO 批量请求，
+    最多 batch_size 个，再把结果分发给各个调用方。
+    """
+
+    def __init__(self, batch_size: int = 20, wait: float = 0.005):
+        self.batch_size = batch_size
+        self.wait = wait
+        # Future只能在创建它的事件循环中使用，因此按事件循环分别收集
+        self._pending: Dict[int, _PendingBatch] = {}
+
+    async def load(self, wxid: str) -> Optional[UserInfo]:
+        """查询单个用户信息，失败时返回None"""
+        # 企业微信用户不需要调用API
+        if wxid.endswith('@openim'):
+            return await get_user_info(wxid)
+
+        loop = asyncio.get_running_loop()
+        loop_id = id(loop)
+
+        batch = self._pending.get(loop_id)
+        if batch is None:
+            batch = self._pending[loop_id] = _PendingBatch()
+            batch.handle = loop.call_later(self.wait, self._dispatch, loop_id, batch)
+
+        future = loop.create_future()
+        batch.futures.setdefault(wxid, []).append(future)
+
+        # 达到批量上限立即发送
+        if len(batch.futures) >= self.batch_size:
+            batch.handle.cancel()
+            self._dispatch(loop_id, batch)
+
+        return await future
+
+    def _dispatch(self, loop_id: int, batch: _PendingBatch):
+        if self._pending.get(loop_id) is batch:
+            del self._pending[loop_id]
+        asyncio.get_running_loop().create_task(self._run(batch))
+
+    @staticmethod
+    async def _run(batch: _PendingBatch):
+        wxids = list(batch.futures)
+        try:
+            user_info_dict = await get_user_info(wxids)
+        except Exception as e:
+            logger.error(f"批量获取用户信息失败: {wxids}, 错误: {e}")
+            user_info_dict = {}
+
+        for wxid, futures in batch.futures.items():
+            user_info = user_info_dict.get(wxid)
+            for future in futures:
+                if not future.done():
+                    future.set_result(user_info)
+
+
+# 全局批量加载器
+user_info_loader = UserInfoLoader()
+
+
+class UserInfoCache:
+    """
+    未保存联系人的用户信息缓存
+
+    成功获取的信息缓存contacts.user_info_ttl_hours小时，获取失败的缓存contacts.user_info_negative_ttl秒，
+    超过contacts.user_info_cache_size条时淘汰最久未使用的记录。修改后延迟写入文件，重启后继续使用。
+    """
+
+    SAVE_DELAY = 5
+
+    def __init__(self, path: str):
+        self.path = path
+        # wxid -> (过期时间, 名称, 头像)，名称为None表示获取失败
+        self._entries: "OrderedDict[str, Tuple[float, Optional[str], str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._save_timer: Optional[threading.Timer] = None
+        self._load()
+        atexit.register(self.save)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                entries = json.load(file)
+            now = time.time()
+            for wxid, (expires_at, name, avatar_url) in entries.items():
+                if expires_at > now:
+                    self._entries[wxid] = (expires_at, name, avatar_url)
+            logger.info(f"用户信息缓存已加载，共 {len(self._entries)} 条记录")
+        except Exception as e:
+            logger.error(f"读取用户信息缓存失败: {e}")
+
+    def get(self, wxid: str) -> Tuple[bool, Optional[UserInfo]]:
+        """
+        Returns:
+            (是否命中, 用户信息)，命中失败记录时用户信息为None
+        """
+        with self._lock:
+            entry = self._entries.get(wxid)
+            if entry is None:
+                return False, None
+            expires_at, name, avatar_url = entry
+            if expires_at <= time.time():
+                del self._entries[wxid]
+                return False, None
+            self._entries.move_to_end(wxid)
+        return True, (UserInfo(name, avatar_url) if name is not None else None)
+
+    def put(self, wxid: str, user_info: Optional[UserInfo]):
+        contacts_cfg = config.cfg.contacts
+        if user_info is not None:
+            entry = (time.time() + contacts_cfg.user_info_ttl_hours * 3600, user_info.name, user_info.avatar_url or "")
+        else:
+            entry = (time.time() + contacts_cfg.user_info_negative_ttl, None, "")
+
+        with self._lock:
+            self._entries[wxid] = entry
+            self._entries.move_to_end(wxid)
+            while len(self._entries) > max(1, contacts_cfg.user_info_cache_size):
+                self._entries.popitem(last=False)
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.SAVE_DELAY, self.save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def invalidate(self, wxid: str):
+        with self._lock:
+            self._entries.pop(wxid, None)
+
+    def save(self):
+        """写入缓存文件"""
+        with self._lock:
+            self._save_timer = None
+            data = json.dumps(self._entries, ensure_ascii=False)
+        try:
+            atomic_write(self.path, data)
+        except Exception as e:
+            logger.error(f"保存用户信息缓存失败: {e}")
+
+
+# 全局用户信息缓存
+user_info_cache = UserInfoCache(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "user_info_cache.json"))
+
+
+async def load_user_info(wxid: str) -> Optional[UserInfo]:
+    """获取单个用户信息，优先使用缓存，短时间内的并发查询会被合并为一次批量请求"""
+    hit, user_info = user_info_cache.get(wxid)
+    if hit:
+        return user_info
+
+    user_info = await user_info_loader.load(wxid)
+    user_info_cache.put(wxid, user_info)
+    return user_info
+
+
 # 修改后的函数
 async def get_friends():
     """
     获取所有好友联系人并分类
     
     Returns:
-        tuple: (friend_contacts, gh_contacts, chatroom_contacts)
+        tuple: (friend_contacts, chatroom_contacts, gh_contacts, complete)
             - friend_contacts: 私聊联系人ID列表（个人用户）
-            - gh_contacts: 以gh_开头的联系人ID列表（公众号）
             - chatroom_contacts: 以@chatroom结尾的联系人ID列表（群聊）
+            - gh_contacts: 以gh_开头的联系人ID列表（公众号）
+            - complete: 是否获取到了全部分页，某一页请求失败时为False，列表只包含已获取的分页
     """
 
     # 初始化变量
@@ -106,6 +292,7 @@ async def get_friends():
     # 存储所有联系人
     all_contacts = []
     page_count = 0
+    complete = False
 
     # 循环获取直到没有更多数据
     while continue_flag == 1:
@@ -149,6 +336,7 @@ async def get_friends():
             # 如果没有更多数据，退出循环
             if continue_flag == 0:
                 logger.debug("已获取所有联系人数据")
+                complete = True
                 break
 
         except Exception as e:
@@ -183,4 +371,7 @@ async def get_friends():
     logger.debug(f"👤 私聊联系人数量: {friend_count}")
     logger.debug("=" * 50)
 
-    return friend_contacts, chatroom_contacts, gh_contacts
+    if not complete:
+        logger.warning(f"联系人列表不完整，第 {page_count} 页获取失败")
+
+    return friend_contacts, chatroom_contacts, gh_contacts, complete
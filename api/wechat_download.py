@@ -1,246 +1,1081 @@
+import asyncio
 import base64
 import datetime
-import io
+import hashlib
+import heapq
+import itertools
+import json
 import math
 import os
-from typing import Tuple
+import re
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, List, Optional, Tuple
 
 from loguru import logger
 
+import config
 from api.wechat_api import wechat_api
 from config import WXID
+from utils.media_store import media_store
 
+# 默认分段大小
+SECTION_SIZE = 256 * 256
+# 每完成多少个分段保存一次断点
+CHECKPOINT_EVERY = 16
 
-async def get_image(msg_id: str, from_wxid: str, data_json) -> Tuple[bool, str, str]:
-    return await chunked_download(
-        api_path="GET_IMAGE",
-        msg_id=msg_id,
-        from_wxid=from_wxid,
-        data_json=data_json,
-        file_key="img",
-        file_extension="png",
-        save_dir="chat_images"
+
+class DownloadError(Exception):
+    """下载失败"""
+
+
+# 下载优先级，数字越小越先执行
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 9
+
+
+class _DownloadJob:
+    """一个下载任务，相同key的请求共享同一个任务"""
+
+    def __init__(self, key: str, priority: int, factory: Callable[[], Awaitable[Any]], future: asyncio.Future):
+        self.key = key
+        self.priority = priority
+        self.factory = factory
+        self.future = future
+        self.task: Optional[asyncio.Task] = None
+
+
+class _ManagerState:
+    """单个事件循环中的下载队列"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.heap: List[Tuple[int, int, _DownloadJob]] = []
+        self.jobs: Dict[str, _DownloadJob] = {}
+        self.running = 0
+
+
+class DownloadManager:
+    """
+    下载管理器
+
+    限制同时进行的下载数量，相同key（md5/attachid）的并发请求只下载一次，
+    排队中的任务按优先级执行，支持取消，并提供队列深度等统计。
+    """
+
+    def __init__(self):
+        self._states: Dict[int, _ManagerState] = {}
+        self._seq = itertools.count()
+        self._stats = {"submitted": 0, "deduplicated": 0, "completed": 0, "failed": 0, "cancelled": 0}
+        self._lock = threading.Lock()
+
+    def _state(self) -> _ManagerState:
+        # Future只能在所属事件循环中使用，因此按事件循环分别排队
+        loop = asyncio.get_running_loop()
+        state = self._states.get(id(loop))
+        if state is None or state.loop is not loop:
+            state = self._states[id(loop)] = _ManagerState(loop)
+        return state
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    async def submit(self, key: str, factory: Callable[[], Awaitable[Any]], priority: int = PRIORITY_NORMAL) -> Any:
+        """
+        提交下载任务并等待结果
+
+        Args:
+            key: 去重键，相同key的任务只执行一次
+            factory: 返回下载协程的函数
+            priority: 优先级，数字越小越先执行
+        """
+        state = self._state()
+        self._count("submitted")
+
+        job = state.jobs.get(key)
+        if job is not None:
+            self._count("deduplicated")
+            # 更高优先级的请求会提升排队中任务的优先级
+            if job.task is None and priority < job.priority:
+                job.priority = priority
+                heapq.heappush(state.heap, (priority, next(self._seq), job))
+        else:
+            job = _DownloadJob(key, priority, factory, state.loop.create_future())
+            state.jobs[key] = job
+            heapq.heappush(state.heap, (priority, next(self._seq), job))
+            self._pump(state)
+
+        # 调用方被取消不影响其它等待同一任务的调用方
+        return await asyncio.shield(job.future)
+
+    def _pump(self, state: _ManagerState):
+        """在并发上限内启动排队中优先级最高的任务"""
+        limit = max(1, config.cfg.download.max_jobs)
+        while state.running < limit and state.heap:
+            priority, _, job = heapq.heappop(state.heap)
+            # 跳过已启动、已取消或优先级已被提升的旧记录
+            if job.task is not None or job.future.done() or priority != job.priority:
+                continue
+            state.running += 1
+            job.task = state.loop.create_task(self._run(state, job))
+
+    async def _run(self, state: _ManagerState, job: _DownloadJob):
+        try:
+            result = await job.factory()
+            if not job.future.done():
+                job.future.set_result(result)
+            self._count("completed")
+        except asyncio.CancelledError:
+            if not job.future.done():
+                job.future.cancel()
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+            self._count("failed")
+        finally:
+            state.running -= 1
+            if state.jobs.get(job.key) is job:
+                del state.jobs[job.key]
+            self._pump(state)
+
+    def cancel(self, key: str) -> bool:
+        """取消当前事件循环中排队或进行中的下载任务"""
+        state = self._state()
+        job = state.jobs.pop(key, None)
+        if job is None:
+            return False
+
+        self._count("cancelled")
+        if job.task is not None:
+            job.task.cancel()
+        elif not job.future.done():
+            job.future.cancel()
+        return True
+
+    def get_stats(self) -> Dict[str, int]:
+        """获取下载统计：排队数、进行中数量和累计计数"""
+        with self._lock:
+            stats = dict(self._stats)
+        states = list(self._states.values())
+        stats["running"] = sum(state.running for state in states)
+        stats["queued"] = sum(1 for state in states for job in state.jobs.values() if job.task is None)
+        return stats
+
+
+# 全局下载管理器
+download_manager = DownloadManager()
+
+
+def _download_key(file_key: str, file_info: dict, msg_id: str) -> str:
+    """下载去重键：优先使用md5，其次attachid，最后msgid"""
+    key = (file_info.get("md5") or
+           (file_info.get("appattach") or {}).get("attachid") or
+           str(msg_id))
+    return f"{file_key}_{re.sub(r'[^A-Za-z0-9_-]', '_', key.lower())}"
+
+
+async def _managed_download(media: "MediaType", msg_id: str, from_wxid: str, data_json: dict,
+                            priority: int) -> Tuple[bool, str, str, str]:
+    """通过下载管理器下载，相同内容的并发下载只执行一次"""
+    file_info = data_json["msg"][media.file_key]
+    key = _download_key(media.file_key, file_info, msg_id)
+
+    success, filepath, filename, file_md5 = await download_manager.submit(
+        key,
+        lambda: chunked_download(media, msg_id, from_wxid, data_json),
+        priority
     )
 
+    # 共享了其它消息的下载结果时，补充本条消息的索引
+    if success:
+        title = file_info.get("title") or ""
+        media_store.record(msg_id, title, file_md5, os.path.splitext(title)[1] or media.extension)
+    return success, filepath, filename, file_md5
+
+
+async def get_media(kind: str, msg_id: str, from_wxid: str, data_json, priority: Optional[int] = None) -> Tuple[bool, str, str, str]:
+    """
+    下载消息中的媒体文件
+
+    Args:
+        kind: 媒体类型，MEDIA_TYPES中的键（img/appmsg/videomsg/voicemsg/emoji）
+        priority: 下载优先级，为空时使用该媒体类型的默认优先级
+
+    Returns:
+        (是否成功, 文件路径或错误信息, 文件名, md5)
+    """
+    media = MEDIA_TYPES[kind]
+    return await _managed_download(media, msg_id, from_wxid, data_json,
+                                   media.priority if priority is None else priority)
+
+
+async def get_image(msg_id: str, from_wxid: str, data_json, priority: int = PRIORITY_NORMAL) -> Tuple[bool, str, str, str]:
+    return await get_media("img", msg_id, from_wxid, data_json, priority)
+
+
+async def get_file(msg_id: str, from_wxid: str, data_json, priority: int = PRIORITY_LOW) -> Tuple[bool, str, str, str]:
+    return await get_media("appmsg", msg_id, from_wxid, data_json, priority)
+
+
+async def get_video(msg_id: str, from_wxid: str, data_json, priority: int = PRIORITY_LOW) -> Tuple[bool, str, str, str]:
+    return await get_media("videomsg", msg_id, from_wxid, data_json, priority)
+
+
+async def get_voice(msg_id: str, from_wxid: str, data_json, priority: int = PRIORITY_NORMAL) -> Tuple[bool, str, str, str]:
+    return await get_media("voicemsg", msg_id, from_wxid, data_json, priority)
+
+
+async def get_emoji(msg_id: str, from_wxid: str, data_json, priority: int = PRIORITY_NORMAL) -> Tuple[bool, str, str, str]:
+    return await get_media("emoji", msg_id, from_wxid, data_json, priority)
+
+
+# 所有下载共享的分段请求并发上限，Semaphore只能在所属事件循环中使用，因此按事件循环分别创建
+# {id(loop): (loop, semaphore, limit)}
+_section_budgets: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore, int]] = {}
+
+
+def _get_section_budget() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    limit = max(1, config.cfg.download.max_inflight)
+
+    cached = _section_budgets.get(id(loop))
+    if cached is not None and cached[0] is loop and cached[2] == limit:
+        return cached[1]
+
+    semaphore = asyncio.Semaphore(limit)
+    _section_budgets[id(loop)] = (loop, semaphore, limit)
+    return semaphore
+
+
+class _PartFile:
+    """下载中的临时文件：按偏移写入分段，内存占用只与分段大小有关"""
+
+    def __init__(self, path: Optional[str] = None, resume: bool = False):
+        self.path = path
+        if path:
+            # 断点续传时保留已下载的内容
+            self.file: BinaryIO = open(path, 'r+b' if resume else 'w+b')
+        else:
+            # 不落盘保存时使用匿名临时文件，关闭后自动删除
+            self.file = tempfile.TemporaryFile()
+        self._lock = threading.Lock()
+        # 下载完成后的内容md5
+        self.md5: Optional[str] = None
+        # 内容是否应与消息中的md5一致（CDN的中图、缩略图不是原图，无法校验）
+        self.verifiable = True
+
+    def allocate(self, length: int):
+        """预分配文件长度"""
+        self.file.truncate(length)
+
+    def write_at(self, offset: int, data: bytes):
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self.file.fileno(), data, offset)
+        else:
+            with self._lock:
+                self.file.seek(offset)
+                self.file.write(data)
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        if hasattr(os, 'pread'):
+            return os.pread(self.file.fileno(), size, offset)
+        with self._lock:
+            self.file.seek(offset)
+            return self.file.read(size)
+
+    def sync(self):
+        """把已写入的分段刷到磁盘"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        """关闭文件，保留内容以便断点续传"""
+        self.file.close()
+
+    def commit(self, target: str):
+        """落盘并原子地重命名为目标文件"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.path, target)
+
+    def detach(self) -> BinaryIO:
+        """返回指向文件开头的文件对象（用于不落盘保存的情况）"""
+        self.file.flush()
+        self.file.seek(0)
+        return self.file
+
+    def discard(self):
+        """放弃下载，删除临时文件"""
+        try:
+            self.file.close()
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+        except OSError as e:
+            logger.warning(f"删除临时文件失败: {self.path}, 错误: {e}")
+
+
+class _IncrementalHasher:
+    """
+    边下载边计算md5
+
+    md5只能按顺序计算：按顺序到达的数据直接计算，乱序到达的区间先记录下来，
+    等前面的数据齐了再从临时文件中读回（此时通常仍在页缓存中），避免下载完成后再完整读一遍文件。
+    """
+
+    READ_SIZE = 1024 * 1024
+
+    def __init__(self, part: "_PartFile", length: int):
+        self.part = part
+        self.length = length
+        self.offset = 0
+        self._md5 = hashlib.md5()
+        self._pending: Dict[int, int] = {}
+
+    def update_at(self, offset: int, data: bytes):
+        """记录写入到offset的数据"""
+        if offset == self.offset:
+            self._md5.update(data)
+            self.offset += len(data)
+        elif offset > self.offset:
+            self._pending[offset] = max(self._pending.get(offset, 0), offset + len(data))
+        self._drain()
+
+    def add_range(self, start: int, end: int):
+        """记录已经在文件中的区间（断点续传时已完成的分段）"""
+        if end > start:
+            self._pending[start] = max(self._pending.get(start, 0), end)
+            self._drain()
+
+    def _drain(self):
+        while self.offset in self._pending:
+            end = self._pending.pop(self.offset)
+            while self.offset < end:
+                data = self.part.read_at(self.offset, min(self.READ_SIZE, end - self.offset))
+                if not data:
+                    return
+                self._md5.update(data)
+                self.offset += len(data)
+
+    def hexdigest(self) -> Optional[str]:
+        """全部数据都计算完成后返回md5"""
+        if self.offset < self.length:
+            return None
+        return self._md5.hexdigest()
+
+
+class _Checkpoint:
+    """断点信息：记录文件长度、分段大小和已完成分段的位图，保存在临时文件旁的 .json 文件中"""
+
+    def __init__(self, path: Optional[str], length: int, section_size: int, done: Optional[bytearray] = None):
+        self.path = path
+        self.length = length
+        self.section_size = section_size
+        self.total = max(1, math.ceil(length / section_size))
+        self.done = done if done is not None else bytearray(math.ceil(self.total / 8))
+        self._unsaved = 0
+        self._save_lock = asyncio.Lock()
+
+    @classmethod
+    def load(cls, path: str) -> Optional["_Checkpoint"]:
+        """读取断点文件，不存在或损坏时返回None"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            checkpoint = cls(path, int(data["length"]), int(data["section_size"]), bytearray.fromhex(data["done"]))
+            if len(checkpoint.done) != math.ceil(checkpoint.total / 8):
+                return None
+            return checkpoint
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"断点文件无效: {path}, 错误: {e}")
+            return None
+
+    def section_range(self, index: int) -> Tuple[int, int]:
+        start = index * self.section_size
+        return start, min(start + self.section_size, self.length)
+
+    def is_done(self, index: int) -> bool:
+        return bool(self.done[index // 8] & (1 << (index % 8)))
+
+    def done_count(self) -> int:
+        return sum(1 for i in range(self.total) if self.is_done(i))
+
+    async def mark(self, index: int, part: "_PartFile"):
+        """标记分段完成，每完成若干分段保存一次断点"""
+        self.done[index // 8] |= 1 << (index % 8)
+        self._unsaved += 1
+        if self._unsaved >= CHECKPOINT_EVERY:
+            await self.save(part)
+
+    async def save(self, part: "_PartFile"):
+        """
+        先把数据刷到磁盘再写断点文件，保证断点中标记完成的分段一定已落盘
+
+        fsync可能很慢，在线程池中执行；位图在提交前复制，之后完成的分段留到下次保存。
+        """
+        if not self.path:
+            return
+        async with self._save_lock:
+            done = bytes(self.done)
+            self._unsaved = 0
+            future = asyncio.get_running_loop().run_in_executor(None, self._write, part, done)
+            try:
+                await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 被取消时仍等待写入完成，避免与之后的保存或关闭文件同时进行
+                await future
+                raise
+
+    def _write(self, part: "_PartFile", done: bytes):
+        try:
+            part.sync()
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "length": self.length,
+                    "section_size": self.section_size,
+                    "done": done.hex()
+                }, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"保存断点失败: {self.path}, 错误: {e}")
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+_last_sweep = 0.0
+
+
+def _sweep_partials(partial_dir: str, ttl: float):
+    """删除超过ttl秒未更新的未完成下载"""
+    now = time.time()
+    try:
+        names = os.listdir(partial_dir)
+    except FileNotFoundError:
+        return
+
+    for name in names:
+        path = os.path.join(partial_dir, name)
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+                logger.info(f"清理过期的未完成下载: {path}")
+        except OSError as e:
+            logger.warning(f"清理未完成下载失败: {path}, 错误: {e}")
+
+
+def _maybe_sweep_partials(partial_dir: str):
+    """每小时最多在后台线程中清理一次过期的未完成下载"""
+    global _last_sweep
+    now = time.time()
+    if now - _last_sweep < 3600:
+        return
+    _last_sweep = now
+
+    ttl = config.cfg.download.partial_ttl_hours * 3600
+    asyncio.get_running_loop().run_in_executor(None, _sweep_partials, partial_dir, ttl)
+
+
+def _message_payload(file_info: dict, msg_id: str, from_wxid: str, start_pos: int, size: int) -> dict:
+    """图片、视频：按消息ID分段下载"""
+    return {
+        "CompressType": 0,
+        "MsgId": msg_id,
+        "Section": {
+            "DataLen": size,
+            "StartPos": start_pos
+        },
+        "Wxid": WXID,
+        "ToWxid": from_wxid
+    }
+
+
+def _attach_payload(file_info: dict, msg_id: str, from_wxid: str, start_pos: int, size: int) -> dict:
+    """文件：按附件ID分段下载"""
+    return {
+        "AppID": file_info["appid"],
+        "AttachId": file_info["appattach"]["attachid"],
+        "Section": {
+            "DataLen": size,
+            "StartPos": start_pos
+        },
+        "UserName": "",
+        "Wxid": WXID
+    }
+
+
+def _voice_payload(file_info: dict, msg_id: str, from_wxid: str, start_pos: int, size: int) -> dict:
+    """语音：一次下载完整内容"""
+    return {
+        "Bufid": file_info.get("bufid") or "0",
+        "FromUserName": file_info.get("fromusername") or from_wxid,
+        "Length": size,
+        "MsgId": msg_id,
+        "Wxid": WXID
+    }
 
-async def get_file(msg_id: str, from_wxid: str, data_json) -> Tuple[bool, str, str]:
-    return await chunked_download(
-        api_path="GET_FILE",
-        msg_id=msg_id,
-        from_wxid=from_wxid,
-        data_json=data_json,
-        file_key="appmsg",
-        file_extension="",
-        save_dir="chat_files"
+
+def _emoji_payload(file_info: dict, msg_id: str, from_wxid: str, start_pos: int, size: int) -> dict:
+    """表情：按md5一次下载完整内容"""
+    return {
+        "Md5": file_info["md5"],
+        "Wxid": WXID
+    }
+
+
+def _build_section_payload(media: "MediaType", file_info: dict, msg_id: str, from_wxid: str,
+                           data_length: Optional[int], start_pos: int, size: int) -> dict:
+    """构建分段下载请求，data_length为None时不携带总长度（用于向网关查询totalLen）"""
+    payload = media.payload(file_info, msg_id, from_wxid, start_pos, size)
+    if data_length is not None:
+        payload["DataLen"] = data_length
+    return payload
+
+
+def _decode_buffer(response_data) -> Optional[bytes]:
+    """从分段下载响应中取出Data.data.buffer并解码，没有buffer时返回None"""
+    try:
+        base64_data = response_data['Data']['data']['buffer']
+    except (KeyError, TypeError):
+        return None
+
+    if not base64_data:
+        return None
+
+    # 移除可能存在的base64头部
+    if ',' in base64_data:
+        base64_data = base64_data.split(',', 1)[1]
+
+    return base64.b64decode(base64_data)
+
+
+def _decode_whole(response_data) -> Optional[bytes]:
+    """从整体下载响应中取出base64内容并解码，没有内容时返回None"""
+    data = (response_data or {}).get('Data') if isinstance(response_data, dict) else None
+    if not isinstance(data, dict):
+        return None
+
+    base64_data = data.get('Base64') or data.get('Image') or data.get('buffer')
+    if not base64_data:
+        return _decode_buffer(response_data)
+
+    if ',' in base64_data:
+        base64_data = base64_data.split(',', 1)[1]
+    return base64.b64decode(base64_data)
+
+
+class SectionSizer:
+    """
+    按接口自适应分段大小
+
+    响应成功且耗时低于目标时逐步加倍，超时、没有buffer或返回数据不足时减小，
+    始终限制在配置的上下限内；学到的大小按接口路径保存，供之后的下载使用。
+    """
+
+    # 连续多少次快速成功后增大分段
+    GROW_AFTER = 4
+
+    def __init__(self):
+        self._sizes: Dict[str, int] = {}
+        self._fast_streak: Dict[str, int] = {}
+        # 网关单次返回的最大字节数，观察到数据不足时记录，之后不再超过它
+        self._ceilings: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bounds() -> Tuple[int, int]:
+        download_cfg = config.cfg.download
+        lower = max(1, download_cfg.section_min_kb) * 1024
+        upper = max(lower, download_cfg.section_max_kb * 1024)
+        return lower, upper
+
+    def get(self, api_path: str) -> int:
+        """当前接口的分段大小"""
+        lower, upper = self._bounds()
+        with self._lock:
+            size = self._sizes.get(api_path, SECTION_SIZE)
+        return min(max(size, lower), upper)
+
+    def record(self, api_path: str, requested: int, received: int, elapsed: float):
+        """记录一次分段请求的结果，received为0表示失败"""
+        lower, upper = self._bounds()
+        target = config.cfg.download.section_target_ms / 1000
+
+        with self._lock:
+            size = min(max(self._sizes.get(api_path, SECTION_SIZE), lower), upper)
+            if received <= 0 or elapsed > target * 2:
+                # 失败或明显过慢
+                new_size = max(lower, size // 2)
+                self._fast_streak[api_path] = 0
+            elif received < requested:
+                # 网关一次最多只能返回received字节
+                new_size = max(lower, min(size, received))
+                self._ceilings[api_path] = received
+                self._fast_streak[api_path] = 0
+            elif requested >= size and elapsed < target:
+                streak = self._fast_streak.get(api_path, 0) + 1
+                if streak >= self.GROW_AFTER:
+                    new_size = min(upper, self._ceilings.get(api_path, upper), size * 2)
+                    new_size = max(new_size, size)
+                    streak = 0
+                else:
+                    new_size = size
+                self._fast_streak[api_path] = streak
+            else:
+                new_size = size
+
+            self._sizes[api_path] = new_size
+
+        if new_size != size:
+            logger.debug(f"分段大小调整 [{api_path}]: {size // 1024}KB -> {new_size // 1024}KB")
+
+    def get_sizes(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._sizes)
+
+
+# 全局分段大小
+section_sizer = SectionSizer()
+
+
+async def _request_section(api_path: str, payload: dict) -> Tuple[Optional[bytes], dict]:
+    """请求一个分段，返回 (解码后的数据, 原始响应)"""
+    async with _get_section_budget():
+        started = time.monotonic()
+        response_data = await wechat_api(api_path, payload)
+        elapsed = time.monotonic() - started
+
+    chunk = _decode_buffer(response_data)
+    section_sizer.record(api_path, payload["Section"]["DataLen"], len(chunk) if chunk else 0, elapsed)
+    return chunk, response_data or {}
+
+
+async def _fetch_range(api_path: str, build_payload, part: _PartFile, hasher: _IncrementalHasher,
+                       start: int, end: int, section_size: int, retries: int):
+    """下载 [start, end) 区间并写入临时文件，网关返回的数据不足时继续请求剩余部分，失败的请求单独重试"""
+    pos = start
+    attempt = 0
+    while pos < end:
+        size = min(section_size, end - pos)
+        chunk, _ = await _request_section(api_path, build_payload(pos, size))
+
+        if not chunk:
+            attempt += 1
+            if attempt > retries:
+                raise DownloadError(f"分段 {start}-{end} 下载失败，已重试 {retries} 次")
+            logger.warning(f"分段 {pos}-{pos + size} 未获取到buffer，第 {attempt} 次重试")
+            await asyncio.sleep(0.2 * attempt)
+            continue
+
+        chunk = chunk[:end - pos]
+        part.write_at(pos, chunk)
+        hasher.update_at(pos, chunk)
+        pos += len(chunk)
+        attempt = 0
+
+
+async def _sectioned_download(media: "MediaType", file_info: dict, msg_id: str, from_wxid: str, data_length: int,
+                              part_path: Optional[str]) -> _PartFile:
+    """
+    分段下载：先请求第一个分段确定文件长度，再并发下载其余分段
+
+    part_path不为空时支持断点续传：已完成的分段记录在 part_path.json 中，重试或重启后只下载缺失的分段。
+
+    Returns:
+        写入完成的临时文件
+    """
+    api_path = media.api_path
+    # 每个文件下载过程中使用固定的分段大小，断点位图依赖它
+    section_size = section_sizer.get(api_path)
+    checkpoint_path = f"{part_path}.json" if part_path else None
+
+    def build_payload(start_pos: int, size: int) -> dict:
+        return _build_section_payload(media, file_info, msg_id, from_wxid, data_length, start_pos, size)
+
+    checkpoint = _Checkpoint.load(checkpoint_path) if checkpoint_path else None
+    first = b""
+    if checkpoint and os.path.exists(part_path):
+        # 断点续传
+        data_length = checkpoint.length
+        section_size = checkpoint.section_size
+        part = _PartFile(part_path, resume=True)
+        hasher = _IncrementalHasher(part, data_length)
+        logger.info(f"继续下载: {part_path}, 已完成 {checkpoint.done_count()}/{checkpoint.total} 个分段")
+    else:
+        first, _ = await _request_section(api_path, build_payload(0, min(section_size, data_length)))
+        if not first and section_size > SECTION_SIZE:
+            # 学到的分段过大时退回默认分段大小
+            section_size = SECTION_SIZE
+            first, _ = await _request_section(api_path, build_payload(0, min(section_size, data_length)))
+        if not first:
+            # 第一次请求获取不到buffer时，去掉DataLen重新请求，从响应中获取totalLen
+            logger.warning("第一次请求未获取到buffer，尝试更改请求参数...")
+            probe_payload = _build_section_payload(media, file_info, msg_id, from_wxid, None, 0, section_size)
+            first, probe_data = await _request_section(api_path, probe_payload)
+
+            total_len = (probe_data.get('Data') or {}).get('totalLen')
+            if not total_len:
+                raise DownloadError("临时请求未能获取到totalLen")
+            data_length = int(total_len)
+
+            if not first:
+                first, _ = await _request_section(api_path, build_payload(0, min(section_size, data_length)))
+                if not first:
+                    raise DownloadError("重试后仍无法获取buffer")
+
+        part = _PartFile(part_path)
+        part.allocate(data_length)
+        first = first[:data_length]
+        part.write_at(0, first)
+        hasher = _IncrementalHasher(part, data_length)
+        hasher.update_at(0, first)
+        checkpoint = _Checkpoint(checkpoint_path, data_length, section_size)
+
+    download_cfg = config.cfg.download
+    logger.debug(f"分段下载: 总长度 {data_length}, 共 {checkpoint.total} 个分段, 并发 {download_cfg.concurrency}")
+
+    async def fetch(index: int):
+        start, end = checkpoint.section_range(index)
+        # 第一个分段可能已经在确定文件长度时下载了一部分
+        if index == 0:
+            start = min(len(first), end)
+        if start < end:
+            await _fetch_range(api_path, build_payload, part, hasher, start, end, section_size, download_cfg.section_retries)
+        await checkpoint.mark(index, part)
+
+    # 断点续传时已完成的分段从文件中读回计算md5
+    missing = 0
+    for i in range(checkpoint.total):
+        if checkpoint.is_done(i):
+            hasher.add_range(*checkpoint.section_range(i))
+        else:
+            missing += 1
+
+    # 固定数量的worker从同一个迭代器中依次取缺失的分段，任务数不随文件大小增长
+    pending = (i for i in range(checkpoint.total) if not checkpoint.is_done(i))
+
+    async def worker():
+        for index in pending:
+            await fetch(index)
+
+    workers = min(max(1, download_cfg.concurrency), missing)
+    tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # 任一分段失败时取消其余分段，保存断点以便下次继续
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if part_path:
+            await checkpoint.save(part)
+            part.close()
+        else:
+            part.discard()
+        raise
+
+    checkpoint.remove()
+    part.md5 = hasher.hexdigest()
+    return part
+
+
+async def _whole_download(media: "MediaType", file_info: dict, msg_id: str, from_wxid: str, data_length: int,
+                          part_path: Optional[str]) -> _PartFile:
+    """不支持分段的媒体（语音、表情）：一次请求下载完整内容"""
+    payload = media.payload(file_info, msg_id, from_wxid, 0, data_length)
+    async with _get_section_budget():
+        response_data = await wechat_api(media.api_path, payload)
+
+    data = _decode_whole(response_data)
+    if not data:
+        raise DownloadError(f"下载失败，响应中没有数据: {media.api_path}")
+
+    part = _PartFile(part_path)
+    part.write_at(0, data)
+    part.md5 = hashlib.md5(data).hexdigest()
+    return part
+
+
+# 最近成功的CDN下载耗时（秒），用于计算对冲延迟
+_cdn_latencies = deque(maxlen=50)
+
+
+def _hedge_delay() -> float:
+    """对冲延迟：配置了hedge_delay_ms时使用配置值，否则取最近CDN耗时的p90"""
+    download_cfg = config.cfg.download
+    if download_cfg.hedge_delay_ms > 0:
+        return download_cfg.hedge_delay_ms / 1000
+
+    if len(_cdn_latencies) < 5:
+        return 1.0
+
+    latencies = sorted(_cdn_latencies)
+    p90 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.9))]
+    return min(max(p90, 0.2), 3.0)
+
+
+async def _cdn_download(data_json: dict, part_path: Optional[str]) -> Optional[_PartFile]:
+    """通过CDN下载图片，失败时返回None"""
+    img_info = data_json["msg"]["img"]
+    aeskey = img_info.get("aeskey")
+    # 按优先级顺序获取第一个非空的CDN URL
+    cdnurl = (img_info.get("cdnbigimgurl") or
+              img_info.get("cdnmidimgurl") or
+              img_info.get("cdnthumburl") or
+              "")
+    if not aeskey or not cdnurl:
+        return None
+
+    try:
+        started = time.monotonic()
+        cdn_body = {
+            "FileAesKey": aeskey,
+            "FileNo": cdnurl,
+            "Wxid": WXID
+        }
+        response_data = await wechat_api("GET_IMAGE_CDN", cdn_body)
+
+        # 检查响应数据结构
+        cdn_base64 = None
+        if response_data and "Data" in response_data and "Image" in response_data["Data"]:
+            cdn_base64 = response_data["Data"]["Image"]
+        if not cdn_base64:
+            return None
+
+        # 移除可能的base64头部
+        if ',' in cdn_base64:
+            cdn_base64 = cdn_base64.split(',', 1)[1]
+        # 解码base64为二进制数据
+        cdn_binary_data = base64.b64decode(cdn_base64)
+        _cdn_latencies.append(time.monotonic() - started)
+
+        part = _PartFile(f"{part_path}.cdn" if part_path else None)
+        part.write_at(0, cdn_binary_data)
+        part.md5 = hashlib.md5(cdn_binary_data).hexdigest()
+        part.verifiable = cdnurl == img_info.get("cdnbigimgurl")
+        return part
+    except Exception as e:
+        logger.warning(f"CDN下载图片失败: {e}")
+        return None
+
+
+def _discard_partial(part_path: Optional[str]):
+    """删除未完成的分段下载及其断点文件"""
+    if not part_path:
+        return
+    for path in (part_path, f"{part_path}.json"):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"删除临时文件失败: {path}, 错误: {e}")
+
+
+async def _hedged_download(cdn: "CdnDownloader", data_json: dict, start_sectioned: Callable[[], Awaitable[_PartFile]],
+                           part_path: Optional[str]) -> _PartFile:
+    """
+    对冲下载：先请求CDN，超过对冲延迟仍未返回时同时开始分段下载，先成功的结果胜出，两者都失败时才报错
+
+    Returns:
+        写入完成的临时文件
+    """
+    cdn_task = asyncio.ensure_future(cdn(data_json, part_path))
+    sectioned_task = None
+
+    try:
+        try:
+            part = await asyncio.wait_for(asyncio.shield(cdn_task), timeout=_hedge_delay())
+            if part is not None:
+                return part
+        except asyncio.TimeoutError:
+            logger.debug("CDN下载未在对冲延迟内完成，同时开始分段下载")
+
+        sectioned_task = asyncio.ensure_future(start_sectioned())
+        pending = {sectioned_task} if cdn_task.done() else {cdn_task, sectioned_task}
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            if cdn_task in done and cdn_task.result() is not None:
+                # CDN胜出，丢弃分段下载的中间结果
+                if sectioned_task in pending:
+                    sectioned_task.cancel()
+                    await asyncio.gather(sectioned_task, return_exceptions=True)
+                _discard_partial(part_path)
+                return cdn_task.result()
+
+            if sectioned_task in done:
+                if sectioned_task.exception() is None or cdn_task not in pending:
+                    # 分段下载胜出，或CDN也已失败
+                    return sectioned_task.result()
+                # 分段下载失败但CDN仍在请求中，继续等待CDN
+                logger.warning(f"分段下载失败，继续等待CDN: {sectioned_task.exception()}")
+
+        # CDN失败后等待分段下载，或两者都已失败（抛出分段下载的错误）
+        return await sectioned_task
+
+    finally:
+        for task in (cdn_task, sectioned_task):
+            if task is not None and not task.done():
+                task.cancel()
+        # 如果CDN在分段下载胜出之后才完成，删除它的结果
+        if sectioned_task is not None and sectioned_task.done() and not sectioned_task.cancelled() \
+                and sectioned_task.exception() is None and cdn_task.done() and not cdn_task.cancelled():
+            late = cdn_task.result()
+            if late is not None:
+                late.discard()
+
+
+CdnDownloader = Callable[[dict, Optional[str]], Awaitable[Optional[_PartFile]]]
+
+
+class MediaType:
+    """
+    一种媒体消息的下载方式
+
+    Attributes:
+        file_key: 消息XML中媒体信息的节点名
+        api_path: 下载接口
+        payload: 请求模板，参数为 (file_info, msg_id, from_wxid, start_pos, size)
+        length_fields: 文件长度所在的字段路径，按顺序取第一个非空值
+        extension: 默认扩展名
+        sectioned: 是否支持分段下载，不支持时一次请求下载完整内容
+        cdn: CDN下载函数，不为空时与分段下载对冲
+        priority: 默认下载优先级
+    """
+
+    def __init__(self, file_key: str, api_path: str, payload: Callable[[dict, str, str, int, int], dict],
+                 length_fields: Tuple[Tuple[str, ...], ...], extension: str, sectioned: bool = True,
+                 cdn: Optional[CdnDownloader] = None, priority: int = PRIORITY_NORMAL):
+        self.file_key = file_key
+        self.api_path = api_path
+        self.payload = payload
+        self.length_fields = length_fields
+        self.extension = extension
+        self.sectioned = sectioned
+        self.cdn = cdn
+        self.priority = priority
+
+    def get_length(self, file_info: dict) -> int:
+        for path in self.length_fields:
+            value = file_info
+            for field in path:
+                value = value.get(field) if isinstance(value, dict) else None
+            if value:
+                return int(value)
+        return 0
+
+    def download(self, file_info: dict, msg_id: str, from_wxid: str, data_length: int,
+                 part_path: Optional[str]) -> Awaitable[_PartFile]:
+        if self.sectioned:
+            return _sectioned_download(self, file_info, msg_id, from_wxid, data_length, part_path)
+        return _whole_download(self, file_info, msg_id, from_wxid, data_length, part_path)
+
+
+MEDIA_TYPES: Dict[str, MediaType] = {
+    media.file_key: media for media in (
+        MediaType("img", "GET_IMAGE", _message_payload, (("length",),), "png", cdn=_cdn_download),
+        MediaType("appmsg", "GET_FILE", _attach_payload, (("appattach", "totallen"),), "", priority=PRIORITY_LOW),
+        MediaType("videomsg", "GET_VIDEO", _message_payload, (("length",),), "mp4", priority=PRIORITY_LOW),
+        MediaType("voicemsg", "GET_VOICE", _voice_payload, (("length",),), "silk", sectioned=False),
+        MediaType("emoji", "GET_EMOJI", _emoji_payload, (("len",),), "gif", sectioned=False),
     )
+}
 
 
 # 分段下载函数
-async def chunked_download(api_path: str, msg_id: str, from_wxid: str, data_json: dict, file_key: str, file_extension: str, save_dir: str = None) -> Tuple[bool, str, str]:
+async def chunked_download(media: MediaType, msg_id: str, from_wxid: str, data_json: dict,
+                           save: bool = True) -> Tuple[bool, str, str, str]:
+    """
+    下载消息中的媒体文件
+
+    下载过程中同时计算md5，并与消息中的md5校验，不一致时丢弃并重新下载，重试后仍不一致时保留最后一次的内容。
+
+    save为True时保存到媒体存储（按md5去重），返回 (是否成功, 文件路径, 文件名, md5)；
+    save为False时不落盘保存，返回 (是否成功, 文件对象, 文件名, md5)。
+    """
     try:
         # 提取文件信息
-        file_info = data_json["msg"][file_key]
-        md5 = file_info.get("md5")
-        if not md5:
-            # 生成 8位日期 + 6位时间 的替代值
-            now = datetime.datetime.now()
-            md5 = now.strftime("%Y%m%d%H%M%S")
-        data_length = int(file_info.get("length") or file_info.get("appattach").get("totallen"))
+        file_info = data_json["msg"][media.file_key]
+        md5 = (file_info.get("md5") or "").lower()
+        data_length = media.get_length(file_info)
         file_title = (file_info.get("title") or "")
+        file_extension = media.extension
+        ext = os.path.splitext(file_title)[1] or file_extension
 
-        # 文件名和路径
+        # 文件名
         if not file_title:
-            filename = f"{md5}.{file_extension}"
+            # 没有md5时使用 8位日期 + 6位时间 的替代值
+            name = md5 or datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+            filename = f"{name}.{file_extension}" if file_extension else name
         else:
             filename = f"{file_title}"
 
-        if save_dir:
-            filepath = os.path.join(save_dir, filename)
-
-            # 检查文件是否已存在
-            if os.path.exists(filepath):
-                return True, filepath
+        part_path = None
+        if save:
+            # 检查文件是否已存在：相同内容（md5），或同一条消息已经下载过
+            filepath = media_store.find(md5)
+            if filepath:
+                # 存储中的文件以内容的md5命名（按别名找到时与消息中的md5不同）
+                media_store.record(msg_id, file_title, os.path.basename(filepath), ext)
+            else:
+                filepath = media_store.lookup(msg_id, file_title)
+            if filepath:
+                return True, filepath, filename, os.path.basename(filepath)
 
-            # 确保保存目录存在
-            os.makedirs(save_dir, exist_ok=True)
+            part_path = os.path.join(media_store.partial_dir, f"{_download_key(media.file_key, file_info, msg_id)}.part")
+            _maybe_sweep_partials(media_store.partial_dir)
 
-        # 用于存储所有分段的二进制数据
-        all_binary_data = bytearray()
-        cdn_success = False
+        def start_download() -> Awaitable[_PartFile]:
+            return media.download(file_info, msg_id, from_wxid, data_length, part_path)
 
-        # 优先使用cdn下载（仅对图片）
-        if file_key == "img":
+        download_cfg = config.cfg.download
+        verify = bool(md5) and download_cfg.verify_md5
+        part = None
+        for attempt in range(download_cfg.verify_retries + 1):
             try:
-                aeskey = data_json["msg"]["img"]["aeskey"]
-                # 按优先级顺序获取第一个非空的CDN URL
-                cdnurl = (data_json["msg"]["img"].get("cdnbigimgurl") or
-                          data_json["msg"]["img"].get("cdnmidimgurl") or
-                          data_json["msg"]["img"].get("cdnthumburl") or
-                          "")
-
-                if cdnurl:
-                    cdn_body = {
-                        "FileAesKey": aeskey,
-                        "FileNo": cdnurl,
-                        "Wxid": WXID
-                    }
-                    response_data = await wechat_api("GET_IMAGE_CDN", cdn_body)
-
-                    # 检查响应数据结构
-                    if (response_data and "Data" in response_data and "Image" in response_data["Data"]):
-                        cdn_base64 = response_data["Data"]["Image"]
-
-                    if cdn_base64:
-                        # 移除可能的base64头部
-                        if ',' in cdn_base64:
-                            cdn_base64 = cdn_base64.split(',', 1)[1]
-                        # 解码base64为二进制数据
-                        cdn_binary_data = base64.b64decode(cdn_base64)
-                        all_binary_data.extend(cdn_binary_data)
-                        cdn_success = True
-            except Exception as e:
-                cdn_success = False
-
-        # 如果CDN下载失败或不是图片，使用分段下载
-        if not cdn_success:
-            # 配置分段大小
-            chunk_size = 256 * 256
-            total_chunks = math.ceil(data_length / chunk_size)
-
-            # 初始化分段参数
-            chunk_index = 1
-            next_start_pos = 0
-            next_chunk_size = min(chunk_size, data_length)
-
-            # 循环下载所有分段
-            retry_attempted = False  # 添加重试标志
-            while True:
-                logger.debug(f"下载分段 {chunk_index}/{total_chunks}, 起始位置: {next_start_pos}, 大小: {next_chunk_size}")
-
-                # 构建请求参数
-                if file_key == "appmsg":
-                    payload = {
-                        "AppID": file_info["appid"],
-                        "AttachId": file_info["appattach"]["attachid"],
-                        "DataLen": data_length,
-                        "Section": {
-                            "DataLen": next_chunk_size,
-                            "StartPos": next_start_pos
-                        },
-                        "UserName": "",
-                        "Wxid": WXID
-                    }
+                if attempt == 0 and media.cdn and not (part_path and os.path.exists(f"{part_path}.json")):
+                    # 支持CDN的媒体：CDN与分段下载对冲（已有未完成的分段下载时直接续传）
+                    part = await _hedged_download(media.cdn, data_json, start_download, part_path)
                 else:
-                    payload = {
-                        "CompressType": 0,
-                        "DataLen": data_length,
-                        "MsgId": msg_id,
-                        "Section": {
-                            "DataLen": next_chunk_size,
-                            "StartPos": next_start_pos
-                        },
-                        "Wxid": WXID,
-                        "ToWxid": from_wxid
-                    }
-
-                # 发送请求
-                response_data = await wechat_api(api_path, payload)
-
-                # 解析响应JSON
-                try:
-                    if 'Data' in response_data and 'data' in response_data['Data'] and 'buffer' in response_data['Data']['data']:
-                        # 获取base64字符串
-                        base64_data = response_data['Data']['data']['buffer']
-
-                        # 移除可能存在的base64头部
-                        if ',' in base64_data:
-                            base64_data = base64_data.split(',', 1)[1]
-
-                        # 解码base64为二进制
-                        binary_chunk = base64.b64decode(base64_data)
-
-                        # 添加到总数据中
-                        all_binary_data.extend(binary_chunk)
-                        logger.debug(f"成功接收分段 {chunk_index}, 大小: {len(binary_chunk)} 字节")
-                    else:
-                        # 当第一次请求获取不到buffer时，尝试更改payload重新请求
-                        if chunk_index == 1 and not retry_attempted:
-                            retry_attempted = True  # 标记已尝试重试
-                            logger.warning("第一次请求未获取到buffer，尝试更改请求参数...")
-
-                            # 临时更改payload
-                            if file_key == "appmsg":
-                                temp_payload = {
-                                    "AppID": file_info["appid"],
-                                    "AttachId": file_info["appattach"]["attachid"],
-                                    "Section": {
-                                        "DataLen": chunk_size,
-                                        "StartPos": 0
-                                    },
-                                    "UserName": "",
-                                    "Wxid": WXID
-                                }
-                            else:
-                                temp_payload = {
-                                    "CompressType": 0,
-                                    "MsgId": msg_id,
-                                    "Section": {
-                                        "DataLen": chunk_size,
-                                        "StartPos": 0
-                                    },
-                                    "Wxid": WXID,
-                                    "ToWxid": from_wxid
-                                }
-
-                            # 发送临时请求
-                            temp_data = await wechat_api(api_path, temp_payload)
-
-                            # 尝试获取totalLen
-                            if 'Data' in temp_data and 'totalLen' in temp_data['Data']:
-                                # 更新data_length
-                                new_data_length = temp_data['Data']['totalLen']
-
-                                # 使用新的data_length重新计算参数
-                                data_length = new_data_length
-                                total_chunks = math.ceil(data_length / chunk_size)
-                                next_chunk_size = min(chunk_size, data_length)
-
-                                # 重新开始下载
-                                continue
-                            else:
-                                logger.error("临时请求未能获取到totalLen，终止下载")
-                                return False, "临时请求未能获取到totalLen"
-                        else:
-                            if chunk_index == 1:
-                                logger.error("重试后仍无法获取buffer，终止下载")
-                                return False, "重试后仍无法获取buffer"
-                            else:
-                                logger.error(f"响应格式错误: 找不到Data.data.buffer字段")
-                                return False, f"响应格式错误: 找不到Data.data.buffer字段"
-                except Exception as e:
-                    logger.error(f"处理响应数据时出错: {str(e)}")
-                    return False, f"处理响应数据时出错: {str(e)}"
-
-                # 检查是否已下载完所有分段
-                if chunk_index == total_chunks:
-                    break
-
-                # 准备下一个请求
-                chunk_index += 1
-                next_start_pos = chunk_size * (chunk_index - 1)
-                remaining_data = data_length - next_start_pos
-                next_chunk_size = min(chunk_size, remaining_data)
-
-        if save_dir:
-            # 将完整的二进制数据写入文件
-            with open(filepath, 'wb') as f:
-                f.write(all_binary_data)
-            return True, filepath, filename
+                    part = await start_download()
+            except DownloadError as e:
+                logger.error(str(e))
+                return False, str(e), "", ""
+
+            if not verify or not part.verifiable or part.md5 == md5:
+                break
+
+            if attempt == download_cfg.verify_retries:
+                # 多次下载仍不一致时保留最后一次的内容（网关可能只提供其它版本的文件）
+                logger.warning(f"md5校验失败: 期望 {md5}, 实际 {part.md5}, 已重试 {attempt} 次，保留下载的内容: {filename}")
+                break
+
+            # 校验失败：丢弃已下载的内容（包括断点），不经过CDN重新下载
+            logger.warning(f"md5校验失败: 期望 {md5}, 实际 {part.md5}, 第 {attempt + 1} 次下载: {filename}")
+            part.discard()
+            _discard_partial(part_path)
+            part = None
+
+        if save:
+            # fsync后原子重命名，避免留下写了一半的文件；fsync可能很慢，放到线程池中执行
+            done_path = f"{part_path}.done"
+            await asyncio.get_running_loop().run_in_executor(None, part.commit, done_path)
+            # 内容与消息中的md5不一致时（CDN中图、校验失败后保留的内容）记录别名，之后的相同消息可以直接找到
+            filepath = media_store.put(done_path, part.md5, ext, msg_id, file_title, alias=md5)
+            return True, filepath, filename, part.md5
         else:
-            # 转换为 BytesIO（推荐）
-            file_buffer = io.BytesIO(all_binary_data)
-            return True, file_buffer, filename
+            # 返回指向临时文件开头的文件对象
+            return True, part.detach(), filename, part.md5
 
     except Exception as e:
         logger.exception(f"下载失败: {str(e)}")
-        return False, f"下载失败: {str(e)}", ""
+        return False, f"下载失败: {str(e)}", "", ""
@@ -1,6 +1,6 @@
 import os
 import sys
-from typing import List
+from typing import Dict, List
 
 import requests
 import yaml
@@ -18,6 +18,10 @@ class Service(BaseModel):
     port: int
     wxid: str
     baseurl: str
+    # 网关的Unix域套接字路径，配置后异步调用通过该套接字连接网关（baseurl仍用于拼接请求路径）
+    uds_path: str = ""
+    # 回调监听额外绑定的Unix域套接字路径，为空则只监听TCP端口
+    listen_uds: str = ""
 
 
 class CaiChengYu(BaseModel):
@@ -28,6 +32,98 @@ class CaiChengYu(BaseModel):
     weekdays: List[int]
 
 
+class Limit(BaseModel):
+    rate: float  # 每秒补充的令牌数，<=0 表示不限速
+    burst: int = 1  # 令牌桶容量，即允许的突发请求数
+
+
+class RateLimit(BaseModel):
+    enable: bool = True
+    # 全局令牌桶，所有接口共享
+    total: Limit = Limit(rate=30, burst=30)
+    # 按接口名称（WeChatAPIPaths 中的属性名）配置的令牌桶
+    endpoints: Dict[str, Limit] = {
+        "SEND_TEXT": Limit(rate=1, burst=3),
+        "USER_INFO": Limit(rate=2, burst=2),
+        "USER_LIST": Limit(rate=2, burst=2),
+        "GROUP_MEMBER": Limit(rate=1, burst=2),
+        "GET_IMAGE_CDN": Limit(rate=5, burst=5),
+        "GET_IMAGE": Limit(rate=20, burst=20),
+        "GET_FILE": Limit(rate=20, burst=20),
+        "GET_VIDEO": Limit(rate=20, burst=20),
+        "GET_VOICE": Limit(rate=5, burst=5),
+        "GET_EMOJI": Limit(rate=5, burst=5),
+    }
+
+
+class Contacts(BaseModel):
+    # 联系人存储: json（contact.json）或 sqlite
+    backend: str = "json"
+    # SQLite数据库路径，相对路径基于项目根目录；首次使用时自动导入contact.json
+    sqlite_path: str = "contact.db"
+    # 检查contact.json外部修改的间隔（秒）
+    watch_interval: float = 2.0
+    # 联系人修改后延迟写入的时间（毫秒），期间的多次修改合并为一次写入
+    write_delay_ms: int = 500
+    # 同步联系人时同时请求的批次数，以及全量同步的间隔（小时），期间只同步新增好友
+    sync_concurrency: int = 4
+    full_sync_hours: int = 24
+    # 未保存联系人的用户信息缓存：有效期（小时），获取失败的有效期（秒），最多缓存的条数
+    user_info_ttl_hours: int = 24
+    user_info_negative_ttl: int = 300
+    user_info_cache_size: int = 2000
+
+
+class Avatar(BaseModel):
+    enable: bool = True
+    # 同时下载的头像数，单个头像下载超时（秒）
+    concurrency: int = 4
+    timeout: int = 15
+    # 超过该时间（小时）后重新验证头像是否变化
+    revalidate_hours: int = 24
+    # 下载失败后该时间（秒）内不再重试，避免头像URL失效时每条消息都请求一次
+    negative_ttl: int = 600
+
+
+class Metrics(BaseModel):
+    # 网关调用耗时超过该值（毫秒）时记录慢调用日志，0 表示关闭
+    slow_call_ms: int = 0
+
+
+class Download(BaseModel):
+    # 同时进行的下载任务数
+    max_jobs: int = 3
+    # 单个文件同时请求的分段数
+    concurrency: int = 4
+    # 所有下载共享的分段请求并发上限
+    max_inflight: int = 8
+    # 单个分段失败后的重试次数
+    section_retries: int = 3
+    # 未完成下载的保留时间（小时），超时后清理
+    partial_ttl_hours: int = 24
+    # 自适应分段大小的下限和上限（KB）
+    section_min_kb: int = 32
+    section_max_kb: int = 1024
+    # 分段请求的目标耗时（毫秒），低于该值时增大分段，超过两倍时减小
+    section_target_ms: int = 1500
+    # 下载完成后与消息中的md5校验，不一致时重新下载的次数
+    verify_md5: bool = True
+    verify_retries: int = 1
+    # 图片CDN下载超过该时间（毫秒）未返回时同时开始分段下载，0 表示按最近CDN耗时的p90自动计算
+    hedge_delay_ms: int = 0
+
+
+class MediaCache(BaseModel):
+    enable: bool = True
+    # 媒体存储的容量上限（MB），0 表示不限制
+    max_mb: int = 2048
+    # 超过该天数未访问的文件被淘汰，0 表示不限制
+    max_age_days: int = 30
+    # 淘汰检查间隔（秒）和每次最多检查的文件数
+    interval: int = 60
+    evict_batch: int = 200
+
+
 class Config(BaseModel):
     logfile: str
     loglevel: str
@@ -35,6 +131,12 @@ class Config(BaseModel):
 
     service: Service
     ccy: CaiChengYu
+    ratelimit: RateLimit = RateLimit()
+    metrics: Metrics = Metrics()
+    download: Download = Download()
+    media_cache: MediaCache = MediaCache()
+    contacts: Contacts = Contacts()
+    avatar: Avatar = Avatar()
 
 
 def load_config(file_path: str) -> Config:
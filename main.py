@@ -1,9 +1,11 @@
 import wechat_syncer
 from utils import caichengyu
+from utils.media_store import media_cache_janitor
 
 
 def main():
     caichengyu.init("chat_images")
+    media_cache_janitor.start()
     wechat_syncer.start()
 
 
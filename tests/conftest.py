@@ -0,0 +1,13 @@
+import os
+import shutil
+import sys
+import tempfile
+
+# 项目根目录加入导入路径
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config 在导入时读取当前目录下的 config.yaml，测试在临时目录中使用示例配置运行
+_workdir = tempfile.mkdtemp(prefix="wegram_test_")
+shutil.copy(os.path.join(ROOT, "config.example.yaml"), os.path.join(_workdir, "config.yaml"))
+os.chdir(_workdir)
@@ -0,0 +1,73 @@
+import asyncio
+import base64
+import hashlib
+import os
+
+import pytest
+
+from api import wechat_download
+from utils.media_store import MediaStore
+
+# CDN只提供中图：内容与消息中记录的原图md5不同
+ORIGINAL = b"original image" * 100
+MID_IMAGE = b"mid image" * 100
+ORIGINAL_MD5 = hashlib.md5(ORIGINAL).hexdigest()
+MID_MD5 = hashlib.md5(MID_IMAGE).hexdigest()
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = MediaStore(str(tmp_path / "media"))
+    monkeypatch.setattr(wechat_download, "media_store", store)
+    return store
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    calls = []
+
+    async def fake_wechat_api(api_path, body=None, *args, **kwargs):
+        calls.append(api_path)
+        if api_path == "GET_IMAGE_CDN":
+            return {"Data": {"Image": base64.b64encode(MID_IMAGE).decode()}}
+        # 分段下载不可用，只能通过CDN获取
+        return {"Data": {}}
+
+    monkeypatch.setattr(wechat_download, "wechat_api", fake_wechat_api)
+    return calls
+
+
+def _image_message():
+    return {"msg": {"img": {"md5": ORIGINAL_MD5, "length": str(len(ORIGINAL)),
+                            "aeskey": "key", "cdnmidimgurl": "mid-url"}}}
+
+
+def test_mid_image_repeat_served_from_store(store, gateway):
+    media = wechat_download.MEDIA_TYPES["img"]
+
+    async def download(msg_id):
+        return await wechat_download.chunked_download(media, msg_id, "wxid_sender", _image_message())
+
+    success, path, _, md5 = asyncio.run(download("1"))
+    assert success and md5 == MID_MD5
+    assert gateway.count("GET_IMAGE_CDN") == 1
+
+    # 另一条消息发送了同一张图片：按消息中的md5找到已保存的中图，不再下载
+    gateway.clear()
+    success, repeat_path, _, repeat_md5 = asyncio.run(download("2"))
+    assert success and repeat_path == path and repeat_md5 == MID_MD5
+    assert gateway == []
+
+    # 重启后别名仍然有效
+    reloaded = MediaStore(store.root)
+    assert reloaded.find(ORIGINAL_MD5) == path
+
+
+def test_lookup_by_message_after_md5_miss(store):
+    src = os.path.join(store.partial_dir, "part")
+    with open(src, "wb") as f:
+        f.write(MID_IMAGE)
+    path = store.put(src, MID_MD5, "jpg", "10", "")
+
+    assert store.find(ORIGINAL_MD5) is None
+    assert store.lookup("10") == path
@@ -0,0 +1,230 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from loguru import logger
+
+import config
+from utils.fileutil import atomic_write
+from utils.media_store import media_store
+
+
+class AvatarCache:
+    """
+    头像缓存
+
+    按 (wxid, 头像URL的hash) 记录已下载的头像，图片保存在媒体存储中。
+    查询只读本地记录，不等待网络：没有缓存或需要重新验证时在后台下载，
+    重新验证时带上ETag/Last-Modified，未修改时只更新验证时间；
+    下载失败的头像在avatar.negative_ttl秒内不再在后台重试。
+    """
+
+    SAVE_DELAY = 5
+    MAX_FAILURES = 1000
+
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        # wxid -> {url_hash, md5, etag, last_modified, checked_at}
+        self._entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._save_timer: Optional[threading.Timer] = None
+        # 正在下载的头像，避免重复下载；同时保留任务引用，避免任务在完成前被回收 {(wxid, url_hash): task}
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        # 下载失败的头像及可以重试的时间 {(wxid, url_hash): retry_after}
+        self._failures: Dict[Tuple[str, str], float] = {}
+        # Semaphore和ClientSession只能在所属事件循环中使用，按事件循环分别创建
+        # {id(loop): (loop, semaphore, session)}
+        self._loops: Dict[int, Tuple[asyncio.AbstractEventLoop, asyncio.Semaphore, aiohttp.ClientSession]] = {}
+        self._load()
+        atexit.register(self.save)
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as file:
+                self._entries = json.load(file)
+            logger.info(f"头像缓存已加载，共 {len(self._entries)} 个头像")
+        except Exception as e:
+            logger.error(f"读取头像缓存失败: {e}")
+
+    def save(self):
+        """写入头像记录"""
+        with self._lock:
+            self._save_timer = None
+            data = json.dumps(self._entries, ensure_ascii=False)
+        try:
+            atomic_write(self.index_path, data)
+        except Exception as e:
+            logger.error(f"保存头像缓存失败: {e}")
+
+    def _schedule_save(self):
+        """延迟写入，调用时需持有_lock"""
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(self.SAVE_DELAY, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    @staticmethod
+    def url_hash(url: str) -> str:
+        return hashlib.md5(url.encode('utf-8')).hexdigest()
+
+    def resolve(self, wxid: str, url: str) -> Optional[str]:
+        """
+        获取头像的本地路径
+
+        没有缓存（或头像URL已变化）时返回None；需要下载或重新验证时在当前事件循环的后台进行，不阻塞调用方。
+        """
+        if not url or not config.cfg.avatar.enable:
+            return None
+
+        url_hash = self.url_hash(url)
+        with self._lock:
+            entry = self._entries.get(wxid)
+        path = None
+        if entry and entry["url_hash"] == url_hash:
+            path = media_store.find(entry["md5"])
+            stale = time.time() - entry.get("checked_at", 0) > config.cfg.avatar.revalidate_hours * 3600
+            if path and not stale:
+                return path
+
+        self._start_fetch(wxid, url, url_hash)
+        return path
+
+    def _start_fetch(self, wxid: str, url: str, url_hash: str, force: bool = False) -> Optional[asyncio.Task]:
+        """
+        在当前事件循环的后台下载头像，已在下载时返回正在进行的任务
+
+        最近下载失败过时不下载，返回None；force为True时忽略失败记录。
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+        key = (wxid, url_hash)
+        with self._lock:
+            if not force and self._failures.get(key, 0) > time.time():
+                return None
+            task = self._inflight.get(key)
+            if task is None:
+                task = loop.create_task(self._fetch(wxid, url, url_hash))
+                self._inflight[key] = task
+        return task
+
+    async def fetch(self, wxid: str, url: str) -> Optional[str]:
+        """下载或重新验证头像并返回本地路径，需要等待结果时使用；已在后台下载时等待该次下载"""
+        if not url:
+            return None
+        url_hash = self.url_hash(url)
+        task = self._start_fetch(wxid, url, url_hash, force=True)
+        if task.get_loop() is asyncio.get_running_loop():
+            await asyncio.shield(task)
+        else:
+            # 下载在其它事件循环中进行，在其所属的事件循环中等待
+            waiter = asyncio.run_coroutine_threadsafe(asyncio.wait([task]), task.get_loop())
+            await asyncio.wait_for(asyncio.wrap_future(waiter), timeout=config.cfg.avatar.timeout)
+
+        with self._lock:
+            entry = self._entries.get(wxid)
+        if entry and entry["url_hash"] == url_hash:
+            return media_store.find(entry["md5"])
+        return None
+
+    def _record_failure(self, key: Tuple[str, str]):
+        now = time.time()
+        with self._lock:
+            if len(self._failures) >= self.MAX_FAILURES:
+                # 清理已过期的记录
+                self._failures = {k: t for k, t in self._failures.items() if t > now}
+            self._failures[key] = now + config.cfg.avatar.negative_ttl
+
+    async def _get_loop_state(self) -> Tuple[asyncio.Semaphore, aiohttp.ClientSession]:
+        loop = asyncio.get_running_loop()
+        cached = self._loops.get(id(loop))
+        if cached is not None and cached[0] is loop and not cached[2].closed:
+            return cached[1], cached[2]
+
+        semaphore = asyncio.Semaphore(max(1, config.cfg.avatar.concurrency))
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=config.cfg.avatar.timeout))
+        self._loops[id(loop)] = (loop, semaphore, session)
+        return semaphore, session
+
+    async def close(self):
+        """关闭当前事件循环的ClientSession，在事件循环结束前调用"""
+        loop = asyncio.get_running_loop()
+        cached = self._loops.get(id(loop))
+        if cached is None or cached[0] is not loop:
+            return
+        del self._loops[id(loop)]
+        await cached[2].close()
+
+    async def _fetch(self, wxid: str, url: str, url_hash: str):
+        try:
+            with self._lock:
+                entry = self._entries.get(wxid)
+            headers = {}
+            # 同一个URL且图片仍在存储中时，带上验证信息
+            if entry and entry["url_hash"] == url_hash and media_store.find(entry["md5"]):
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
+            else:
+                entry = None
+
+            semaphore, session = await self._get_loop_state()
+            async with semaphore:
+                async with session.get(url, headers=headers) as response:
+                    if response.status == 304 and entry is not None:
+                        with self._lock:
+                            self._failures.pop((wxid, url_hash), None)
+                            entry["checked_at"] = time.time()
+                            self._schedule_save()
+                        return
+                    response.raise_for_status()
+                    data = await response.read()
+                    etag = response.headers.get("ETag", "")
+                    last_modified = response.headers.get("Last-Modified", "")
+                    content_type = response.headers.get("Content-Type", "")
+
+            md5 = hashlib.md5(data).hexdigest()
+            ext = ".png" if "png" in content_type else ".jpg"
+
+            def _store():
+                fd, tmp_path = tempfile.mkstemp(prefix="avatar_", suffix=".tmp", dir=media_store.partial_dir)
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(data)
+                media_store.put(tmp_path, md5, ext)
+
+            await asyncio.get_running_loop().run_in_executor(None, _store)
+
+            with self._lock:
+                self._failures.pop((wxid, url_hash), None)
+                self._entries[wxid] = {
+                    "url_hash": url_hash,
+                    "md5": md5,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "checked_at": time.time()
+                }
+                self._schedule_save()
+            logger.debug(f"头像已缓存: {wxid}")
+
+        except Exception as e:
+            logger.warning(f"下载头像失败: {wxid}, {url}, 错误: {e}")
+            self._record_failure((wxid, url_hash))
+        finally:
+            with self._lock:
+                self._inflight.pop((wxid, url_hash), None)
+
+
+# 创建全局实例
+avatar_cache = AvatarCache(os.path.join(media_store.root, "avatars.json"))
@@ -3,6 +3,7 @@ import hashlib
 import os
 import random
 import re
+import shutil
 import time
 from typing import Dict
 
@@ -11,9 +12,12 @@ from loguru import logger
 import config
 from api import wechat_download
 from utils import call_wechat_api
+from utils.media_store import media_store
 from config import cfg
 
 save_file = ''
+# 下载时计算的图片md5
+save_file_md5 = ''
 
 
 def get_file_md5(file_path: str, chunk_size: int = 4096) -> str:
@@ -103,20 +107,25 @@ def handle_text(content: str):
     answer = get_answer(content)
     logger.debug(f"过滤答案：{answer}")
     if answer:
-        parent_path = os.path.dirname(save_file)
-        save_path = os.path.join(parent_path, answer + ".png")
+        save_path = os.path.join(images_dir, answer + ".png")
         if os.path.exists(save_path):
-            save_path = os.path.join(parent_path, answer + str(random.randint(1, 100)) + ".png")
-
-        logger.debug(f"重命名文件：{save_path}")
-        os.rename(save_file, save_path)
+            save_path = os.path.join(images_dir, answer + str(random.randint(1, 100)) + ".png")
+
+        # 下载的图片保存在媒体存储中，复制一份到成语图片目录（优先使用硬链接）
+        logger.debug(f"保存文件：{save_path}")
+        try:
+            os.link(save_file, save_path)
+        except OSError:
+            shutil.copyfile(save_file, save_path)
         save_file = None
-        image_md5s[get_file_md5(save_path)] = answer
+        answer_md5 = save_file_md5 or get_file_md5(save_path)
+        image_md5s[answer_md5] = answer
+        media_store.pin([answer_md5])
         logger.debug(f"成语总数：{len(image_md5s)}")
 
 
 async def handle_image(msg_id, from_wxid, content):
-    global save_file
+    global save_file, save_file_md5
 
     if not in_time_range(cfg.ccy.img_time_range[0], cfg.ccy.img_time_range[1]):
         return
@@ -144,20 +153,25 @@ async def handle_image(msg_id, from_wxid, content):
     else:
         # 异步下载图片
         logger.info(f"下载图片开始")
-        success, file, _ = await wechat_download.get_image(msg_id, from_wxid, content)
+        success, file, _, file_md5 = await wechat_download.get_image(msg_id, from_wxid, content, wechat_download.PRIORITY_HIGH)
         logger.info(f"下载图片结束：{success} 路径：{file}")
-        save_file = file
+        save_file = file if success else None
+        save_file_md5 = file_md5 if success else ''
 
 
 image_md5s = {}
+images_dir = "chat_images"
 
 
 def init(images_path: str):
     if not config.cfg.ccy.enable:
         return
 
-    global image_md5s
+    global image_md5s, images_dir
+    images_dir = images_path
     image_md5s = collect_image_md5s(images_path)
+    # 成语图片不参与媒体存储的淘汰
+    media_store.pin(image_md5s)
     logger.debug(f"成语总数：{len(image_md5s)}")
 
 
@@ -1,131 +1,266 @@
 import asyncio
+import atexit
 import json
 import os
-from typing import Dict, Optional
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
 
 from loguru import logger
 
+import config
 from api import wechat_contacts
+from utils.contact_search import ContactSearchIndex, build_search_index
+from utils.contact_store import create_contact_store
+from utils.fileutil import atomic_write
 
 
-# 异步版本的ContactManager类
-class ContactManager:
-    def __init__(self):
-        self.contacts = []
-        self.wxid_to_contact = {}
-        self.chatid_to_wxid = {}
-        self.last_modified_time = 0
-        self.contact_file_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "contact.json")
+class ContactSnapshot:
+    """
+    联系人快照，创建后不再修改
 
-        # 初始加载联系人（同步方式，用于初始化）
-        self._load_contacts_sync()
+    联系人列表、wxId索引和chatId索引总是一致的；修改联系人时创建新的快照（联系人字典也复制后再修改），
+    读取方拿到快照后可以不加锁地多次查询。
+    """
 
-    def _load_contacts_sync(self):
-        """同步加载联系人信息（仅用于初始化）"""
-        try:
-            if not os.path.exists(self.contact_file_path):
-                self.contacts = []
-                self.wxid_to_contact = {}
-                self.chatid_to_wxid = {}
-                return
+    __slots__ = ("contacts", "wxid_to_contact", "chatid_to_wxid")
 
-            current_mtime = os.path.getmtime(self.contact_file_path)
-            if current_mtime <= self.last_modified_time:
-                return
+    def __init__(self, contacts: Iterable[dict] = ()):
+        self.contacts: Tuple[dict, ...] = tuple(contacts)
+        self.wxid_to_contact: Dict[str, dict] = {contact["wxId"]: contact for contact in self.contacts}
+        self.chatid_to_wxid: Dict[int, str] = {contact["chatId"]: contact["wxId"] for contact in self.contacts if "chatId" in contact}
 
-            with open(self.contact_file_path, 'r', encoding='utf-8') as file:
-                self.contacts = json.load(file)
-                self.wxid_to_contact = {contact["wxId"]: contact for contact in self.contacts}
-                self.chatid_to_wxid = {contact["chatId"]: contact["wxId"] for contact in self.contacts if "chatId" in contact}
-                self.last_modified_time = current_mtime
+    def __len__(self):
+        return len(self.contacts)
 
-            logger.info(f"联系人信息已更新，共 {len(self.contacts)} 个联系人")
+    def get(self, wxid: str) -> Optional[dict]:
+        return self.wxid_to_contact.get(wxid)
 
-        except Exception as e:
-            logger.error(f"读取联系人文件失败: {e}")
-            self.contacts = []
-            self.wxid_to_contact = {}
-            self.chatid_to_wxid = {}
-
-    async def load_contacts(self):
-        """异步加载联系人信息"""
-        try:
-            if not os.path.exists(self.contact_file_path):
-                self.contacts = []
-                self.wxid_to_contact = {}
-                self.chatid_to_wxid = {}
-                return
+    def get_wxid_by_chatid(self, chat_id) -> Optional[str]:
+        return self.chatid_to_wxid.get(int(chat_id))
 
-            # 异步获取文件修改时间
-            loop = asyncio.get_event_loop()
-            current_mtime = await loop.run_in_executor(None, os.path.getmtime, self.contact_file_path)
+    def get_by_chatid(self, chat_id) -> Optional[dict]:
+        wxid = self.get_wxid_by_chatid(chat_id)
+        return self.wxid_to_contact.get(wxid) if wxid else None
 
-            if current_mtime <= self.last_modified_time:
-                return
+    def with_changes(self, upserts: Iterable[dict] = (), deletes: Iterable[str] = ()) -> "ContactSnapshot":
+        """返回应用修改后的新快照：已存在的wxId原位替换，新的追加到末尾"""
+        upserts = {contact["wxId"]: contact for contact in upserts}
+        deletes = set(deletes) - upserts.keys()
+        contacts = []
+        for contact in self.contacts:
+            wxid = contact["wxId"]
+            if wxid in deletes:
+                continue
+            contacts.append(upserts.pop(wxid, contact))
+        contacts.extend(upserts.values())
+        return ContactSnapshot(contacts)
 
-            # 异步读取文件
-            def _read_file():
-                with open(self.contact_file_path, 'r', encoding='utf-8') as file:
-                    return json.load(file)
 
-            contacts = await loop.run_in_executor(None, _read_file)
+# 异步版本的ContactManager类
+class ContactManager:
+    """
+    联系人管理
 
-            self.contacts = contacts
-            self.wxid_to_contact = {contact["wxId"]: contact for contact in self.contacts}
-            self.chatid_to_wxid = {contact["chatId"]: contact["wxId"] for contact in self.contacts if "chatId" in contact}
-            self.last_modified_time = current_mtime
+    内存中的联系人快照是权威数据，查询只读快照；修改时创建新快照后替换引用。
+    联系人存储（contact.json或SQLite）被外部修改时，由后台线程加载并替换为新的快照，加载失败时保留原快照。
+    """
 
-            logger.info(f"联系人信息已更新，共 {len(self.contacts)} 个联系人")
+    def __init__(self):
+        self._snapshot = ContactSnapshot()
+        # 修改快照时持有，保证“读取-修改-替换”不被其它修改打断
+        self._snapshot_lock = threading.Lock()
+        # 每次修改快照时加一，重新加载期间发生修改时放弃加载的结果
+        self._version = 0
+        self.search_index = ContactSearchIndex()
+        self.contact_file_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "contact.json")
+        # 联系人同步记录
+        self.sync_checkpoint_path = os.path.join(os.path.dirname(self.contact_file_path), "contact_sync.json")
+        contacts_cfg = config.cfg.contacts
+        self.store = create_contact_store(contacts_cfg.backend, self.contact_file_path, contacts_cfg.sqlite_path)
+        self._reload_lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+        # 延迟合并写入：等待写入的修改和定时器
+        self._write_lock = threading.Lock()
+        self._pending_upserts: Dict[str, dict] = {}
+        self._pending_deletes = set()
+        self._dirty = False
+        self._flush_timer: Optional[threading.Timer] = None
+        atexit.register(self.flush)
 
-        except Exception as e:
-            logger.error(f"读取联系人文件失败: {e}")
-            self.contacts = []
-            self.wxid_to_contact = {}
-            self.chatid_to_wxid = {}
+        # 初始加载联系人（同步方式，用于初始化）
+        self._load_contacts_sync()
 
-    async def _save_contacts(self):
-        """异步保存联系人信息到文件"""
-        try:
-            loop = asyncio.get_event_loop()
+        # 后台监听联系人存储的外部修改
+        self._watch_thread = threading.Thread(target=self._watch, daemon=True)
+        self._watch_thread.start()
 
-            def _write_file():
-                with open(self.contact_file_path, 'w', encoding='utf-8') as file:
-                    json.dump(self.contacts, file, ensure_ascii=False, indent=2)
+    def snapshot(self) -> ContactSnapshot:
+        """当前的联系人快照，处理一条消息时获取一次"""
+        return self._snapshot
 
-            await loop.run_in_executor(None, _write_file)
+    @property
+    def contacts(self) -> Tuple[dict, ...]:
+        return self._snapshot.contacts
 
-            # 更新修改时间
-            self.last_modified_time = await loop.run_in_executor(None, os.path.getmtime, self.contact_file_path)
+    @property
+    def wxid_to_contact(self) -> Dict[str, dict]:
+        return self._snapshot.wxid_to_contact
 
-        except Exception as e:
-            logger.error(f"保存联系人文件失败: {e}")
-            raise
+    @property
+    def chatid_to_wxid(self) -> Dict[int, str]:
+        return self._snapshot.chatid_to_wxid
 
-    async def delete_contact(self, wxid: str) -> bool:
-        """删除联系人信息"""
-        try:
-            # 先加载最新的联系人信息
-            await self.load_contacts()
+    def _set_contacts(self, contacts: list, version: int) -> bool:
+        """
+        根据联系人列表构建新的快照后替换
 
-            # 检查联系人是否存在
-            if wxid not in self.wxid_to_contact:
-                logger.warning(f"联系人不存在: {wxid}")
+        读取联系人之后快照被修改过（version不同）或有未写入的修改时不替换，避免丢失这些修改。
+        """
+        snapshot = ContactSnapshot(contacts)
+        search_index = build_search_index(snapshot.contacts)
+        with self._snapshot_lock:
+            if self._version != version or self._dirty:
+                return False
+            self._snapshot = snapshot
+            self.search_index = search_index
+            self._version += 1
+        return True
+
+    def _apply_changes(self, upserts: List[dict] = (), deletes: List[str] = ()):
+        """用修改后的新快照替换当前快照，调用时需持有_snapshot_lock"""
+        self._version += 1
+        self._snapshot = self._snapshot.with_changes(upserts, deletes)
+        for wxid in deletes:
+            self.search_index.remove(wxid)
+        for contact in upserts:
+            self.search_index.add(contact)
+
+    def _load_contacts_sync(self) -> bool:
+        """
+        联系人存储被修改时重新加载联系人信息
+
+        读取失败时保留当前的联系人信息。
+
+        Returns:
+            是否重新加载
+        """
+        with self._reload_lock:
+            try:
+                # 还有未写入的修改时不加载，避免覆盖内存中的修改
+                if self._dirty or not self.store.changed():
+                    return False
+
+                version = self._version
+                contacts = self.store.load()
+                if contacts is None:
+                    return False
+
+                if not self._set_contacts(contacts, version):
+                    logger.debug("读取联系人期间内存中的联系人被修改，放弃本次加载")
+                    return False
+                logger.info(f"联系人信息已更新，共 {len(self._snapshot)} 个联系人")
+                return True
+
+            except Exception as e:
+                logger.error(f"读取联系人失败: {e}")
                 return False
 
-            # 获取要删除的联系人信息
-            contact_to_delete = self.wxid_to_contact[wxid]
-            chat_id = contact_to_delete.get("chatId")
+    def _watch(self):
+        """后台线程：定期检查联系人存储是否被外部修改"""
+        while not self._stop_event.wait(config.cfg.contacts.watch_interval):
+            self._load_contacts_sync()
 
-            # 从内存中删除
-            self.contacts = [contact for contact in self.contacts if contact["wxId"] != wxid]
-            del self.wxid_to_contact[wxid]
+    def stop(self):
+        """停止监听线程"""
+        self._stop_event.set()
 
-            # 如果有chatId，也从映射中删除
-            if chat_id and chat_id in self.chatid_to_wxid:
-                del self.chatid_to_wxid[chat_id]
+    async def load_contacts(self):
+        """立即检查联系人存储是否被修改（平时由后台线程检查，查询无需调用）"""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._load_contacts_sync)
+
+    async def _save_contacts(self, upserts: List[dict] = (), deletes: List[str] = ()):
+        """
+        记录联系人修改，在contacts.write_delay_ms内的多次修改合并为一次写入
+
+        Args:
+            upserts: 新增或修改的联系人
+            deletes: 删除的联系人wxId
+        """
+        with self._write_lock:
+            for wxid in deletes:
+                self._pending_upserts.pop(wxid, None)
+                self._pending_deletes.add(wxid)
+            for contact in upserts:
+                self._pending_deletes.discard(contact["wxId"])
+                self._pending_upserts[contact["wxId"]] = contact
+            self._dirty = True
+            self._schedule_flush(config.cfg.contacts.write_delay_ms / 1000)
+
+    def _schedule_flush(self, delay: float):
+        """在delay秒后写入，已有定时器时不重复创建（调用时需持有_write_lock）"""
+        if self._flush_timer is not None:
+            return
+        self._flush_timer = threading.Timer(delay, self._flush_from_timer)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
+    def _flush_from_timer(self):
+        with self._write_lock:
+            self._flush_timer = None
+        if not self.flush():
+            # 写入失败时稍后重试
+            with self._write_lock:
+                self._schedule_flush(max(config.cfg.contacts.write_delay_ms / 1000, 5))
+
+    def flush(self) -> bool:
+        """
+        立即写入所有未保存的修改（程序退出时自动调用）
+
+        Returns:
+            是否写入成功
+        """
+        with self._reload_lock:
+            with self._write_lock:
+                if not self._dirty:
+                    return True
+                upserts = list(self._pending_upserts.values())
+                deletes = list(self._pending_deletes)
+                self._pending_upserts = {}
+                self._pending_deletes = set()
+                self._dirty = False
+
+            try:
+                self.store.apply(list(self._snapshot.contacts), upserts, deletes)
+                return True
+            except Exception as e:
+                logger.error(f"保存联系人失败: {e}")
+                # 放回等待写入的修改，后来的修改优先
+                with self._write_lock:
+                    for wxid in deletes:
+                        if wxid not in self._pending_upserts:
+                            self._pending_deletes.add(wxid)
+                    for contact in upserts:
+                        if contact["wxId"] not in self._pending_deletes:
+                            self._pending_upserts.setdefault(contact["wxId"], contact)
+                    self._dirty = True
+                return False
+
+    async def delete_contact(self, wxid: str) -> bool:
+        """删除联系人信息"""
+        try:
+            with self._snapshot_lock:
+                # 检查联系人是否存在
+                if self._snapshot.get(wxid) is None:
+                    logger.warning(f"联系人不存在: {wxid}")
+                    return False
 
-            # 保存到文件
-            await self._save_contacts()
+                self._apply_changes(deletes=[wxid])
+
+            # 保存
+            await self._save_contacts(deletes=[wxid])
 
             return True
 
@@ -152,65 +287,53 @@ class ContactManager:
     async def update_contact_by_chatid(self, chat_id: int, updates: dict) -> bool:
         """通过ChatID更新联系人的指定字段"""
         try:
-            # 先加载最新的联系人信息
-            await self.load_contacts()
-
-            # 通过chatId获取wxId
-            wxid = self.chatid_to_wxid.get(int(chat_id))
-            if not wxid:
-                return False
-
-            # 找到联系人在列表中的索引
-            contact_index = -1
-            for i, contact in enumerate(self.contacts):
-                if contact["wxId"] == wxid:
-                    contact_index = i
-                    break
-
-            if contact_index == -1:
-                return False
-
-            # 批量更新字段
-            for key, value in updates.items():
-                # 特殊处理切换布尔值
-                if value == "toggle" and key in ["isReceive", "isGroup"]:
-                    current_value = self.contacts[contact_index].get(key, False)
-                    value = not current_value
-                elif key in ["isReceive", "isGroup"] and isinstance(value, str):
-                    # 如果传入字符串，转换为布尔值
-                    value = value.lower() in ['true', '1', 'yes', 'on']
-
-                # 更新字段
-                self.contacts[contact_index][key] = value
-                self.wxid_to_contact[wxid][key] = value
-
-            # 保存到文件
-            await self._save_contacts()
+            with self._snapshot_lock:
+                # 通过chatId获取联系人，复制后修改
+                current = self._snapshot.get_by_chatid(chat_id)
+                if current is None:
+                    return False
+                contact = dict(current)
+
+                # 批量更新字段
+                for key, value in updates.items():
+                    # 特殊处理切换布尔值
+                    if value == "toggle" and key in ["isReceive", "isGroup"]:
+                        current_value = contact.get(key, False)
+                        value = not current_value
+                    elif key in ["isReceive", "isGroup"] and isinstance(value, str):
+                        # 如果传入字符串，转换为布尔值
+                        value = value.lower() in ['true', '1', 'yes', 'on']
+
+                    # 更新字段
+                    contact[key] = value
+
+                self._apply_changes(upserts=[contact])
+
+            # 保存
+            await self._save_contacts(upserts=[contact])
             return True
 
         except Exception as e:
             logger.error(f"更新联系人字段失败 - ChatID: {chat_id}, 更新: {updates}, 错误: {e}")
             return False
 
-    async def search_contacts_by_name(self, username: str = "") -> list:
-        """根据用户名搜索联系人"""
-        try:
-            # 先加载最新的联系人信息
-            await self.load_contacts()
-
-            if not username or not username.strip():
-                return self.contacts
+    async def search_contacts_by_name(self, username: str = "", limit: int = 0) -> list:
+        """
+        根据名称搜索联系人
 
-            # 搜索name字段包含username的联系人（不区分大小写）
-            username_lower = username.strip().lower()
-            matching_contacts = []
+        匹配name、alias、remark，支持拼音和拼音首字母（需安装pypinyin），
+        结果按完全匹配、前缀、子串、拼音、模糊匹配排序。
 
-            for contact in self.contacts:
-                contact_name = contact.get("name", "")
-                if contact_name and username_lower in contact_name.lower():
-                    matching_contacts.append(contact)
+        Args:
+            username: 搜索词，为空时返回全部联系人
+            limit: 最多返回的结果数，0 表示不限制
+        """
+        try:
+            if not username or not username.strip():
+                contacts = list(self._snapshot.contacts)
+                return contacts[:limit] if limit > 0 else contacts
 
-            return matching_contacts
+            return self.search_index.search(username, limit)
 
         except Exception as e:
             logger.error(f"搜索联系人失败 - 用户名: {username}, 错误: {e}")
@@ -218,143 +341,189 @@ class ContactManager:
 
     async def get_contact(self, wxid):
         """异步获取联系人信息"""
-        await self.load_contacts()
-        contact = self.wxid_to_contact.get(wxid)
-        return contact
+        return self._snapshot.get(wxid)
 
     async def get_wxid_by_chatid(self, chat_id):
         """异步通过chatId获取wxId"""
-        await self.load_contacts()
-        return self.chatid_to_wxid.get(int(chat_id))
+        return self._snapshot.get_wxid_by_chatid(chat_id)
 
     async def get_contact_by_chatid(self, chat_id):
         """异步通过chatId获取联系人完整信息"""
-        wxid = await self.get_wxid_by_chatid(chat_id)
-        return await self.get_contact(wxid) if wxid else None
+        return self._snapshot.get_by_chatid(chat_id)
 
     async def check_existing_mapping(self, wxid: str) -> Optional[Dict]:
         """检查是否已有映射"""
-        await self.load_contacts()
-        for contact in self.contacts:
-            if contact.get('wxId') == wxid and contact.get('chatId'):
-                return contact
+        contact = self._snapshot.get(wxid)
+        if contact is not None and contact.get('chatId'):
+            return contact
         return None
 
     async def save_chat_wxid_mapping(self, wxid: str, name: str, chat_id: int, avatar_url: str = None):
         """保存群组ID和微信ID的映射关系"""
-        await self.load_contacts()
-
-        # 检查是否已存在
-        for contact in self.contacts:
-            if contact.get('wxId') == wxid and contact.get('chatId') == chat_id:
+        with self._snapshot_lock:
+            # 检查是否已存在
+            existing = self._snapshot.get(wxid)
+            if existing is not None and existing.get('chatId') == chat_id:
                 return
 
-        is_group = wxid.endswith('@chatroom')
-        new_contact = {
-            "name": name,
-            "wxId": wxid,
-            "chatId": chat_id,
-            "isGroup": is_group,
-            "isReceive": True,
-            "alias": "",
-            "avatarLink": avatar_url
-        }
-
-        self.contacts.append(new_contact)
-        self.wxid_to_contact[wxid] = new_contact
-        self.chatid_to_wxid[chat_id] = wxid
-
-        await self._save_contacts()
-
-    async def update_contacts_and_sync_to_json(self, chat_id: int):
-        """获取联系人列表并同步到contact.json"""
+            is_group = wxid.endswith('@chatroom')
+            new_contact = {
+                "name": name,
+                "wxId": wxid,
+                "chatId": chat_id,
+                "isGroup": is_group,
+                "isReceive": True,
+                "alias": "",
+                "avatarLink": avatar_url
+            }
+
+            # 同一个wxId只保留新的映射
+            self._apply_changes(upserts=[new_contact])
+
+        await self._save_contacts(upserts=[new_contact])
+
+    def _load_sync_checkpoint(self) -> dict:
+        """读取上次同步的记录：好友列表和上次全量同步的时间"""
+        try:
+            if os.path.exists(self.sync_checkpoint_path):
+                with open(self.sync_checkpoint_path, 'r', encoding='utf-8') as file:
+                    return json.load(file)
+        except Exception as e:
+            logger.warning(f"读取同步记录失败，将全量同步: {e}")
+        return {}
+
+    def _save_sync_checkpoint(self, members: List[str], last_full: float):
+        try:
+            atomic_write(self.sync_checkpoint_path,
+                         json.dumps({"last_full": last_full, "members": members}, ensure_ascii=False))
+        except Exception as e:
+            logger.error(f"保存同步记录失败: {e}")
+
+    @staticmethod
+    async def _fetch_user_infos(wxids: List[str]) -> Dict[str, Optional[wechat_contacts.UserInfo]]:
+        """按每批20个并发获取用户信息（请求频率由wechat_api的限流器控制）"""
+        batch_size = 20
+        batches = [wxids[i:i + batch_size] for i in range(0, len(wxids), batch_size)]
+        total_batches = len(batches)
+        semaphore = asyncio.Semaphore(max(1, config.cfg.contacts.sync_concurrency))
+        finished = 0
+
+        async def fetch(batch_index: int, batch: List[str]) -> dict:
+            nonlocal finished
+            async with semaphore:
+                try:
+                    return await wechat_contacts.get_user_info(batch) or {}
+                except Exception as e:
+                    logger.error(f"处理批次 {batch_index + 1} 时出错: {str(e)}")
+                    return {}
+                finally:
+                    finished += 1
+                    if finished % 5 == 0 or finished == total_batches:
+                        logger.info(f"⏳ 处理进度: {finished}/{total_batches} 批次")
+
+        results = await asyncio.gather(*(fetch(i, batch) for i, batch in enumerate(batches)))
+        user_infos = {}
+        for result in results:
+            user_infos.update(result)
+        return user_infos
+
+    async def update_contacts_and_sync_to_json(self, chat_id: int, full: bool = False):
+        """
+        获取联系人列表并同步到联系人存储
+
+        与上次同步的好友列表比较，只获取新增好友和存储中缺失的联系人信息；
+        距上次全量同步超过contacts.full_sync_hours或full为True时，重新获取全部联系人信息，
+        更新名称和头像有变化的联系人。修改合并为一次写入。
+        """
         try:
             # 发送开始处理的消息
             logger.info("🔄 正在获取联系人列表...")
 
             # 获取联系人列表
-            friend_contacts, chatroom_contacts, gh_contacts = await wechat_contacts.get_friends()
+            friend_contacts, chatroom_contacts, gh_contacts, complete = await wechat_contacts.get_friends()
             all_contacts = friend_contacts + chatroom_contacts
             if not all_contacts:
                 # await telegram_sender.send_text(chat_id, "❌ 未获取到好友联系人")
                 return
 
-            logger.info(f"📋 获取到 {len(all_contacts)} 个好友，正在同步信息...")
-
-            # 将all_contacts按每组20个分割
-            batch_size = 20
-            batches = [all_contacts[i:i + batch_size] for i in range(0, len(all_contacts), batch_size)]
+            checkpoint = self._load_sync_checkpoint()
+            now = time.time()
+            previous_members = set(checkpoint.get("members") or [])
+            full = (full or not checkpoint or
+                    now - checkpoint.get("last_full", 0) > config.cfg.contacts.full_sync_hours * 3600)
 
-            new_contacts_count = 0
-            total_batches = len(batches)
-
-            # 处理每个批次
-            for batch_index, batch in enumerate(batches):
-                try:
-                    # 发送进度更新
-                    if batch_index % 5 == 0 or batch_index == total_batches - 1:  # 每5个批次或最后一个批次更新进度
-                        progress = f"⏳ 处理进度: {batch_index + 1}/{total_batches} 批次"
-                        logger.info(progress)
-
-                    # 调用get_user_info获取用户信息
-                    user_info_dict = await wechat_contacts.get_user_info(batch)
-
-                    if not user_info_dict:
-                        logger.warning(f"批次 {batch_index + 1} 未获取到用户信息")
-                        continue
-
-                    # 遍历用户信息
-                    for wxid, user_info in user_info_dict.items():
-                        if user_info is None:
-                            logger.warning(f"用户 {wxid} 信息获取失败")
-                            continue
-
-                        # 检查wxId是否已存在于contact.json中
-                        existing_contact = await self.get_contact(wxid)
-
-                        if existing_contact is None:
-                            # 不存在则创建新联系人
-                            new_contact = {
-                                "name": user_info.name,
-                                "wxId": wxid,
-                                "chatId": -9999999999,
-                                "isGroup": False,
-                                "isReceive": True,
-                                "alias": "",
-                                "avatarLink": user_info.avatar_url if user_info.avatar_url else ""
-                            }
-
-                            # 添加到联系人管理器
-                            self.contacts.append(new_contact)
-                            self.wxid_to_contact[wxid] = new_contact
-
-                            new_contacts_count += 1
-                            logger.info(f"添加新联系人: {user_info.name} ({wxid})")
-
-                    # 每处理几个批次休眠一下，避免请求过于频繁
-                    if batch_index < total_batches - 1:  # 不是最后一个批次
-                        await asyncio.sleep(0.5)  # 休眠500毫秒
-
-                except Exception as e:
-                    logger.error(f"处理批次 {batch_index + 1} 时出错: {str(e)}")
+            current_members = set(all_contacts)
+            snapshot = self._snapshot
+            if full:
+                to_fetch = all_contacts
+            else:
+                to_fetch = [wxid for wxid in all_contacts
+                            if wxid not in previous_members or snapshot.get(wxid) is None]
+            logger.info(f"📋 获取到 {len(all_contacts)} 个好友，{'全量' if full else '增量'}同步 {len(to_fetch)} 个联系人信息...")
+
+            user_infos = await self._fetch_user_infos(to_fetch)
+
+            # 比较获取到的信息和已保存的联系人
+            new_contacts = []
+            changed_contacts = []
+            for wxid in to_fetch:
+                user_info = user_infos.get(wxid)
+                if user_info is None:
+                    logger.warning(f"用户 {wxid} 信息获取失败")
                     continue
 
-            # 保存所有更改到文件
-            if new_contacts_count > 0:
-                await self._save_contacts()
-                success_msg = f"✅ 同步完成！新增 {new_contacts_count} 个联系人到contact.json"
+                avatar_url = user_info.avatar_url if user_info.avatar_url else ""
+                existing_contact = snapshot.get(wxid)
+                if existing_contact is None:
+                    new_contacts.append({
+                        "name": user_info.name,
+                        "wxId": wxid,
+                        "chatId": -9999999999,
+                        "isGroup": wxid.endswith('@chatroom'),
+                        "isReceive": True,
+                        "alias": "",
+                        "avatarLink": avatar_url
+                    })
+                    logger.info(f"添加新联系人: {user_info.name} ({wxid})")
+                elif existing_contact.get("name") != user_info.name or existing_contact.get("avatarLink") != avatar_url:
+                    changed_contacts.append((wxid, user_info.name, avatar_url))
+
+            with self._snapshot_lock:
+                # 获取信息期间联系人可能被修改，基于最新的快照应用修改
+                snapshot = self._snapshot
+                new_contacts = [contact for contact in new_contacts if snapshot.get(contact["wxId"]) is None]
+                updated_contacts = [dict(snapshot.get(wxid), name=name, avatarLink=avatar_url)
+                                    for wxid, name, avatar_url in changed_contacts if snapshot.get(wxid) is not None]
+
+                # 不再是好友、且没有绑定会话的联系人（由同步添加）；列表不完整时无法判断，不删除
+                removed_wxids = [wxid for wxid in previous_members - current_members
+                                 if (snapshot.get(wxid) or {}).get("chatId") == -9999999999] if complete else []
+
+                upserts = new_contacts + updated_contacts
+                if upserts or removed_wxids:
+                    self._apply_changes(upserts=upserts, deletes=removed_wxids)
+
+            if upserts or removed_wxids:
+                await self._save_contacts(upserts=upserts, deletes=removed_wxids)
+            if complete:
+                self._save_sync_checkpoint(sorted(current_members), now if full else checkpoint.get("last_full", 0))
             else:
-                success_msg = "✅ 同步完成！所有联系人已存在，无新增联系人"
+                logger.warning("联系人列表不完整，跳过移除联系人和保存同步进度")
 
+            success_msg = (f"✅ 同步完成！新增 {len(new_contacts)} 个，更新 {len(updated_contacts)} 个，"
+                           f"移除 {len(removed_wxids)} 个联系人")
             logger.info(success_msg)
 
             # 发送统计信息
             stats_msg = f"""
     📊 **同步统计**
     • 总好友数: {len(all_contacts)}
-    • 新增联系人: {new_contacts_count}
-    • 处理批次: {total_batches}
-    • 当前联系人总数: {len(self.contacts)}
+    • 同步方式: {'全量' if full else '增量'}
+    • 获取信息: {len(to_fetch)}
+    • 新增联系人: {len(new_contacts)}
+    • 更新联系人: {len(updated_contacts)}
+    • 移除联系人: {len(removed_wxids)}
+    • 当前联系人总数: {len(self._snapshot)}
             """
             logger.info(stats_msg)
 
@@ -0,0 +1,209 @@
+import heapq
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+from loguru import logger
+
+try:
+    # 可选依赖：安装后支持按拼音和拼音首字母搜索
+    from pypinyin import Style, lazy_pinyin
+except ImportError:
+    lazy_pinyin = None
+
+# 参与搜索的联系人字段
+SEARCH_FIELDS = ("name", "alias", "remark")
+
+# 匹配类型，数值越小排名越靠前
+RANK_EXACT = 0
+RANK_PREFIX = 1
+RANK_SUBSTRING = 2
+RANK_PINYIN_PREFIX = 3
+RANK_PINYIN_SUBSTRING = 4
+RANK_FUZZY = 5
+
+
+def _pinyin_keys(text: str) -> List[str]:
+    """中文转为拼音全拼和首字母，未安装pypinyin或不含中文时返回空列表"""
+    if lazy_pinyin is None or not any('\u4e00' <= ch <= '\u9fff' for ch in text):
+        return []
+    full = "".join(lazy_pinyin(text)).lower()
+    initials = "".join(lazy_pinyin(text, style=Style.FIRST_LETTER)).lower()
+    return [full, initials]
+
+
+def _grams(text: str) -> Set[str]:
+    """单字和相邻两字，单字用于一个字的查询和模糊匹配的候选筛选"""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+def _is_subsequence(query: str, text: str) -> bool:
+    it = iter(text)
+    return all(ch in it for ch in query)
+
+
+class ContactSearchIndex:
+    """
+    联系人搜索索引
+
+    对name、alias、remark（以及它们的拼音全拼、首字母）建立单字和二元组倒排索引，
+    查询时先用倒排索引取候选，再按完全匹配、前缀、子串、拼音、模糊匹配排序。
+    """
+
+    CACHE_SIZE = 256
+
+    def __init__(self, contacts: Iterable[dict] = ()):
+        # wxId -> [(是否拼音, 小写文本)]
+        self._keys: Dict[str, List[Tuple[bool, str]]] = {}
+        # 单字/二元组 -> wxId集合
+        self._postings: Dict[str, Set[str]] = {}
+        self._contacts: Dict[str, dict] = {}
+        # 同一匹配类型内按名称长度、名称排序
+        self._order: Dict[str, Tuple[int, str]] = {}
+        # 查询结果缓存，联系人变化时清空
+        self._cache: Dict[Tuple[str, int, bool], List[dict]] = {}
+        # 修改和查询可能来自不同线程
+        self._lock = threading.RLock()
+        for contact in contacts:
+            self.add(contact)
+
+    def __len__(self):
+        return len(self._contacts)
+
+    def add(self, contact: dict):
+        """添加或更新联系人"""
+        with self._lock:
+            self._add(contact)
+
+    def _add(self, contact: dict):
+        wxid = contact.get("wxId")
+        if not wxid:
+            return
+        self._cache.clear()
+        if wxid in self._keys:
+            self._remove(wxid)
+
+        keys = []
+        for field in SEARCH_FIELDS:
+            text = (contact.get(field) or "").strip().lower()
+            if not text:
+                continue
+            keys.append((False, text))
+            keys.extend((True, key) for key in _pinyin_keys(text))
+
+        name = contact.get("name") or ""
+        self._contacts[wxid] = contact
+        self._order[wxid] = (len(name), name)
+        self._keys[wxid] = keys
+        for _, text in keys:
+            for gram in _grams(text):
+                self._postings.setdefault(gram, set()).add(wxid)
+
+    def remove(self, wxid: str):
+        """删除联系人"""
+        with self._lock:
+            self._remove(wxid)
+
+    def _remove(self, wxid: str):
+        self._cache.clear()
+        self._contacts.pop(wxid, None)
+        self._order.pop(wxid, None)
+        for _, text in self._keys.pop(wxid, ()):
+            for gram in _grams(text):
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    postings.discard(wxid)
+                    if not postings:
+                        del self._postings[gram]
+
+    def _candidates(self, grams: Set[str]) -> Set[str]:
+        """包含全部单字/二元组的联系人"""
+        result = None
+        for gram in sorted(grams, key=lambda g: len(self._postings.get(g, ()))):
+            postings = self._postings.get(gram)
+            if not postings:
+                return set()
+            result = set(postings) if result is None else result & postings
+            if not result:
+                break
+        return result or set()
+
+    @staticmethod
+    def _rank(query: str, keys: List[Tuple[bool, str]]) -> int:
+        best = None
+        for is_pinyin, text in keys:
+            if best == RANK_EXACT:
+                break
+            if text == query:
+                rank = RANK_PINYIN_PREFIX if is_pinyin else RANK_EXACT
+            elif text.startswith(query):
+                rank = RANK_PINYIN_PREFIX if is_pinyin else RANK_PREFIX
+            elif query in text:
+                rank = RANK_PINYIN_SUBSTRING if is_pinyin else RANK_SUBSTRING
+            elif _is_subsequence(query, text):
+                rank = RANK_FUZZY
+            else:
+                continue
+            if best is None or rank < best:
+                best = rank
+        return best
+
+    def search(self, query: str, limit: int = 0, fuzzy: bool = True) -> List[dict]:
+        """
+        搜索联系人
+
+        Args:
+            query: 搜索词，不区分大小写，支持拼音和拼音首字母
+            limit: 最多返回的结果数，0 表示不限制
+            fuzzy: 是否包含模糊匹配（按顺序包含搜索词的全部字符）
+
+        Returns:
+            按匹配程度排序的联系人列表
+        """
+        query = "".join(query.split()).lower()
+        if not query:
+            return []
+
+        with self._lock:
+            return list(self._search(query, limit, fuzzy))
+
+    def _search(self, query: str, limit: int, fuzzy: bool) -> List[dict]:
+
+        cache_key = (query, limit, fuzzy)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        # 先取包含全部单字/二元组的候选（完全、前缀、子串匹配），数量不足时再取模糊匹配候选
+        candidates = self._candidates(_grams(query))
+        ranked = self._rank_candidates(query, candidates, fuzzy=False)
+        if fuzzy and (limit <= 0 or len(ranked) < limit):
+            fuzzy_candidates = self._candidates(set(query)) - candidates
+            ranked.extend(self._rank_candidates(query, fuzzy_candidates, fuzzy=True))
+
+        if limit > 0:
+            ranked = heapq.nsmallest(limit, ranked, key=lambda item: item[:3])
+        else:
+            ranked.sort(key=lambda item: item[:3])
+        result = [item[3] for item in ranked]
+
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[cache_key] = result
+        return result
+
+    def _rank_candidates(self, query: str, candidates: Set[str], fuzzy: bool) -> list:
+        ranked = []
+        for wxid in candidates:
+            rank = self._rank(query, self._keys[wxid])
+            if rank is None or (rank == RANK_FUZZY) != fuzzy:
+                continue
+            ranked.append((rank,) + self._order[wxid] + (self._contacts[wxid],))
+        return ranked
+
+
+def build_search_index(contacts: Iterable[dict]) -> ContactSearchIndex:
+    index = ContactSearchIndex(contacts)
+    logger.debug(f"联系人搜索索引已建立，共 {len(index)} 个联系人")
+    return index
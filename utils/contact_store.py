@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+from typing import Iterable, List, Optional
+
+from loguru import logger
+
+from utils.fileutil import atomic_write
+
+# 项目根目录
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class JsonContactStore:
+    """联系人存储：contact.json，每次保存重写整个文件"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_modified_time = 0
+
+    def changed(self) -> bool:
+        """文件是否在上次读取或写入之后被修改"""
+        if not os.path.exists(self.path):
+            return False
+        return os.path.getmtime(self.path) != self.last_modified_time
+
+    def load(self) -> Optional[List[dict]]:
+        """读取全部联系人，文件不存在时返回None"""
+        if not os.path.exists(self.path):
+            return None
+        # 读取失败时等文件再次修改后才重试
+        self.last_modified_time = os.path.getmtime(self.path)
+        with open(self.path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def apply(self, contacts: List[dict], upserts: Iterable[dict] = (), deletes: Iterable[str] = ()):
+        """保存修改，JSON文件只能整体重写（每个联系人一行，原子替换）"""
+        lines = ",\n".join(json.dumps(contact, ensure_ascii=False) for contact in contacts)
+        atomic_write(self.path, f"[\n{lines}\n]\n" if contacts else "[]\n")
+        # 更新修改时间，避免把自己写入的文件当作外部修改重新加载
+        self.last_modified_time = os.path.getmtime(self.path)
+
+    def close(self):
+        pass
+
+
+class SqliteContactStore:
+    """
+    联系人存储：SQLite（WAL模式）
+
+    wxId为主键，chatId和name建索引，联系人的完整字段以JSON保存在data列中；
+    修改只写入变化的行，多处修改在同一个事务中提交。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS contacts (
+                wxId TEXT PRIMARY KEY,
+                chatId INTEGER,
+                name TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_contacts_chatid ON contacts(chatId);
+            CREATE INDEX IF NOT EXISTS idx_contacts_name ON contacts(name);
+        """)
+        self._conn.commit()
+        # 其它连接提交修改后data_version会变化，用于检测外部修改
+        self._data_version = None
+
+    def _read_data_version(self) -> int:
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed(self) -> bool:
+        """数据库是否被其它连接修改"""
+        with self._lock:
+            return self._read_data_version() != self._data_version
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM contacts").fetchone()[0]
+
+    def load(self) -> Optional[List[dict]]:
+        """按写入顺序读取全部联系人"""
+        with self._lock:
+            self._data_version = self._read_data_version()
+            rows = self._conn.execute("SELECT data FROM contacts ORDER BY rowid").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    @staticmethod
+    def _row(contact: dict) -> tuple:
+        return (contact["wxId"], contact.get("chatId"), contact.get("name"),
+                json.dumps(contact, ensure_ascii=False))
+
+    def apply(self, contacts: List[dict], upserts: Iterable[dict] = (), deletes: Iterable[str] = ()):
+        """在一个事务中写入新增/修改的联系人和删除的联系人"""
+        rows = [self._row(contact) for contact in upserts]
+        deletes = [(wxid,) for wxid in deletes]
+        if not rows and not deletes:
+            return
+
+        with self._lock:
+            with self._conn:
+                if deletes:
+                    self._conn.executemany("DELETE FROM contacts WHERE wxId = ?", deletes)
+                if rows:
+                    self._conn.executemany("""
+                        INSERT INTO contacts (wxId, chatId, name, data) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(wxId) DO UPDATE SET chatId = excluded.chatId, name = excluded.name, data = excluded.data
+                    """, rows)
+
+    def import_json(self, json_path: str) -> int:
+        """从contact.json导入联系人，已存在的wxId会被覆盖"""
+        with open(json_path, 'r', encoding='utf-8') as file:
+            contacts = json.load(file)
+        self.apply(contacts, upserts=contacts)
+        logger.info(f"已从 {json_path} 导入 {len(contacts)} 个联系人")
+        return len(contacts)
+
+    def export_json(self, json_path: str) -> int:
+        """导出联系人到contact.json格式的文件"""
+        contacts = self.load()
+        atomic_write(json_path, json.dumps(contacts, ensure_ascii=False, indent=2))
+        logger.info(f"已导出 {len(contacts)} 个联系人到 {json_path}")
+        return len(contacts)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_contact_store(backend: str, json_path: str, sqlite_path: str):
+    """
+    根据配置创建联系人存储
+
+    使用SQLite且数据库为空时，自动导入已有的contact.json。
+    """
+    if backend != "sqlite":
+        return JsonContactStore(json_path)
+
+    if not os.path.isabs(sqlite_path):
+        sqlite_path = os.path.join(BASE_DIR, sqlite_path)
+    store = SqliteContactStore(sqlite_path)
+    if store.count() == 0 and os.path.exists(json_path):
+        store.import_json(json_path)
+    return store
+
+
+if __name__ == '__main__':
+    # 用法: python -m utils.contact_store import|export [contact.json] [contact.db]
+    if len(sys.argv) < 2 or sys.argv[1] not in ("import", "export"):
+        print("用法: python -m utils.contact_store import|export [contact.json] [contact.db]")
+        sys.exit(1)
+
+    json_file = sys.argv[2] if len(sys.argv) > 2 else os.path.join(BASE_DIR, "contact.json")
+    db_file = sys.argv[3] if len(sys.argv) > 3 else os.path.join(BASE_DIR, "contact.db")
+    sqlite_store = SqliteContactStore(db_file)
+    if sys.argv[1] == "import":
+        sqlite_store.import_json(json_file)
+    else:
+        sqlite_store.export_json(json_file)
+    sqlite_store.close()
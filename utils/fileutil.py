@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+
+def atomic_write(path: str, data: str, encoding: str = 'utf-8'):
+    """
+    原子写入文件：先写入同目录下的临时文件并fsync，再重命名覆盖目标文件
+
+    写入过程中崩溃时目标文件保持原样，不会留下写了一半的内容。
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding=encoding) as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    # 同步目录，确保重命名落盘
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
@@ -1,6 +1,6 @@
 import json
 import os
-from typing import Dict, List, Any, Callable
+from typing import Dict, List, Any, Callable, Tuple
 
 from loguru import logger
 
@@ -30,8 +30,41 @@ class GroupMemberManager:
         # 确保目录存在
         os.makedirs(os.path.dirname(self.json_file_path), exist_ok=True)
 
+        # (群ID, 用户名) -> 显示名称，随群成员数据一起维护
+        self._display_names: Dict[Tuple[str, str], str] = {}
+        # 用户名 -> {群ID: 显示名称}
+        self._user_groups: Dict[str, Dict[str, str]] = {}
+
         # 加载现有数据
         self.data = self.load_from_json()
+        for chatroom_id, members in self.data.items():
+            self._index_group(chatroom_id, members)
+
+    @staticmethod
+    def _member_display_name(member: Dict[str, str]) -> str:
+        return member["displayname"] if member["displayname"] else member["nickname"]
+
+    def _index_group(self, chatroom_id: str, members: List[Dict[str, str]]):
+        """把群成员加入索引，同一个用户出现多次时使用第一次的显示名称"""
+        for member in members:
+            username = member["username"]
+            key = (chatroom_id, username)
+            if key in self._display_names:
+                continue
+            display_name = self._member_display_name(member)
+            self._display_names[key] = display_name
+            self._user_groups.setdefault(username, {})[chatroom_id] = display_name
+
+    def _unindex_group(self, chatroom_id: str):
+        """从索引中移除群成员"""
+        for member in self.data.get(chatroom_id, []):
+            username = member["username"]
+            self._display_names.pop((chatroom_id, username), None)
+            groups = self._user_groups.get(username)
+            if groups is not None:
+                groups.pop(chatroom_id, None)
+                if not groups:
+                    del self._user_groups[username]
 
     def load_from_json(self) -> Dict[str, List[Dict[str, str]]]:
         """从JSON文件加载数据"""
@@ -51,6 +84,9 @@ class GroupMemberManager:
 
             # 如果有新数据，合并到现有数据中
             if new_data is not None:
+                for chatroom_id, members in new_data.items():
+                    self._unindex_group(chatroom_id)
+                    self._index_group(chatroom_id, members)
                 self.data.update(new_data)
                 data_to_save = self.data
 
@@ -128,6 +164,7 @@ class GroupMemberManager:
         try:
             if chatroom_id in self.data:
                 # 从内存中删除
+                self._unindex_group(chatroom_id)
                 del self.data[chatroom_id]
 
                 # 保存到JSON文件
@@ -152,17 +189,14 @@ class GroupMemberManager:
                 "QID": chatroom_id,
                 "Wxid": config.WXID
             }
+            # 并发的相同请求会被wechat_api合并，这里只需由第一个拿到结果的调用方写入文件
             group_member_response = await wechat_api("GROUP_MEMBER", payload)
 
-            new_data = self.extract_members(group_member_response)
-            self.save_to_json(new_data)
-
-        if chatroom_id in self.data:
-            for member in self.data[chatroom_id]:
-                if member["username"] == username:
-                    return member["displayname"] if member["displayname"] else member["nickname"]
+            if chatroom_id not in self.data:
+                new_data = self.extract_members(group_member_response)
+                self.save_to_json(new_data)
 
-        return ""
+        return self._display_names.get((chatroom_id, username), "")
 
     def get_all_members(self, chatroom_id: str) -> List[Dict[str, str]]:
         """获取指定群的所有成员"""
@@ -170,16 +204,23 @@ class GroupMemberManager:
 
     def search_user_across_groups(self, username: str) -> Dict[str, str]:
         """跨群查询用户，返回用户在各个群中的显示名"""
-        result = {}
+        return dict(self._user_groups.get(username, {}))
 
-        for chatroom_id, members in self.data.items():
-            for member in members:
-                if member["username"] == username:
-                    display_name = member["displayname"] if member["displayname"] else member["nickname"]
-                    result[chatroom_id] = display_name
-                    break
+    def get_common_groups(self, username: str, other: str = None) -> List[str]:
+        """
+        获取共同所在的群
 
-        return result
+        Args:
+            username: 用户名
+            other: 另一个用户名，为空时返回username所在的所有群
+        """
+        groups = self._user_groups.get(username, {})
+        if other is None:
+            return list(groups)
+        other_groups = self._user_groups.get(other, {})
+        if len(other_groups) < len(groups):
+            groups, other_groups = other_groups, groups
+        return [chatroom_id for chatroom_id in groups if chatroom_id in other_groups]
 
     def get_chatroom_list(self) -> List[str]:
         """获取所有群组ID列表"""
@@ -198,11 +239,11 @@ class GroupMemberManager:
 
     def get_unique_users(self) -> set:
         """获取所有唯一用户的集合"""
-        unique_users = set()
-        for members in self.data.values():
-            for member in members:
-                unique_users.add(member["username"])
-        return unique_users
+        return set(self._user_groups)
+
+    def get_unique_user_count(self) -> int:
+        """获取所有群组的唯一用户数"""
+        return len(self._user_groups)
 
     def batch_update_groups(self, wechat_api_func: Callable, chatroom_ids: List[str]) -> Dict[str, bool]:
         """
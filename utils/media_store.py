@@ -0,0 +1,395 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set
+
+from loguru import logger
+
+import config
+from utils.fileutil import atomic_write
+
+
+class MediaStore:
+    """
+    按内容寻址的媒体存储
+
+    文件以md5命名，按md5前两级前缀分目录存放（blobs/ab/cd/abcd...），相同内容只保存一份；
+    索引记录 (msg_id, title) 到文件md5和扩展名的映射，以及消息中的md5与实际内容md5不同时的别名，
+    以追加方式写入 index.jsonl；
+    被覆盖或文件已淘汰的记录达到一定数量后整体重写索引文件。
+
+    在内存中按最近访问顺序记录每个文件的大小和访问时间，用于按容量和时间淘汰，
+    固定（pin）的文件不会被淘汰。
+    """
+
+    # 无效的索引记录至少达到这个数量、且不少于有效记录数时重写索引文件
+    COMPACT_MIN = 1000
+
+    def __init__(self, root: str = None):
+        if root is None:
+            # 默认路径: 项目根目录/media
+            root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "media")
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        # 未完成的下载
+        self.partial_dir = os.path.join(root, "partial")
+        self.index_path = os.path.join(root, "index.jsonl")
+
+        self._index: Dict[str, Dict[str, str]] = {}
+        # md5 -> 引用它的索引key，用于淘汰文件时删除对应的索引记录
+        self._md5_keys: Dict[str, Set[str]] = {}
+        # 索引文件中被覆盖或已失效的记录数
+        self._stale = 0
+        self._lock = threading.Lock()
+
+        # md5 -> [文件大小, 最近访问时间]，按访问顺序排列，最早访问的在前
+        self._usage: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._total_bytes = 0
+        self._pinned: Set[str] = set()
+        # 启动时扫描一次已有文件后才开始淘汰
+        self._scanned = False
+
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self._load_index()
+        self.compact()
+
+    def _load_index(self):
+        """读取索引文件，后写入的记录覆盖先写入的"""
+        if not os.path.exists(self.index_path):
+            return
+
+        lines = 0
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                        if "alias" in entry:
+                            key = self._alias_key(entry["alias"])
+                        else:
+                            key = self._key(entry["msg_id"], entry["title"])
+                        self._set_entry(key, entry)
+                    except (ValueError, KeyError):
+                        logger.warning(f"跳过无效的媒体索引记录: {line}")
+            self._stale = lines - len(self._index)
+            logger.info(f"媒体索引已加载，共 {len(self._index)} 条记录")
+        except Exception as e:
+            logger.error(f"读取媒体索引失败: {e}")
+
+    @staticmethod
+    def _key(msg_id, title: str) -> str:
+        return f"{msg_id}:{title or ''}"
+
+    @staticmethod
+    def _alias_key(md5: str) -> str:
+        return f"alias:{md5}"
+
+    def _set_entry(self, key: str, entry: Dict[str, str]) -> bool:
+        """更新内存中的索引记录，返回是否覆盖了已有记录"""
+        old = self._index.get(key)
+        if old is not None:
+            self._unlink_key(old["md5"], key)
+        self._index[key] = entry
+        self._md5_keys.setdefault(entry["md5"], set()).add(key)
+        return old is not None
+
+    def _unlink_key(self, md5: str, key: str):
+        keys = self._md5_keys.get(md5)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._md5_keys[md5]
+
+    def _drop_md5(self, md5: str) -> int:
+        """删除指向md5的索引记录，返回删除的数量，调用时需持有_lock"""
+        keys = self._md5_keys.pop(md5, ())
+        for key in keys:
+            del self._index[key]
+        return len(keys)
+
+    @staticmethod
+    def normalize_ext(ext: str) -> str:
+        """统一扩展名格式为 '.png'，没有扩展名时返回空字符串"""
+        ext = (ext or "").strip().lower()
+        if ext and not ext.startswith('.'):
+            ext = f".{ext}"
+        return ext
+
+    def blob_path(self, md5: str) -> str:
+        """根据md5计算文件路径"""
+        md5 = md5.lower()
+        return os.path.join(self.blob_dir, md5[:2], md5[2:4], md5)
+
+    def find(self, md5: str) -> Optional[str]:
+        """按md5查找已保存的文件，也可以是消息中记录的md5（别名）"""
+        if not md5:
+            return None
+        md5 = md5.lower()
+        path = self.blob_path(md5)
+        if not os.path.exists(path):
+            alias = self._index.get(self._alias_key(md5))
+            if alias is None:
+                return None
+            md5 = alias["md5"]
+            path = self.blob_path(md5)
+            if not os.path.exists(path):
+                return None
+        self.touch(md5)
+        return path
+
+    def lookup(self, msg_id, title: str = "") -> Optional[str]:
+        """按 (msg_id, title) 查找已保存的文件"""
+        entry = self._index.get(self._key(msg_id, title))
+        if entry is None:
+            return None
+        return self.find(entry["md5"])
+
+    def put(self, src_path: str, md5: str, ext: str = "", msg_id=None, title: str = "", alias: str = "") -> str:
+        """
+        把下载完成的文件移入存储
+
+        Args:
+            src_path: 下载完成的临时文件，会被移动或删除
+            md5: 文件内容的md5
+            ext: 扩展名，写入索引
+            msg_id: 消息ID，与title一起写入索引
+            title: 原始文件名
+            alias: 消息中记录的md5，与文件内容的md5不同时（如CDN的中图）记录为别名，之后按它也能找到文件
+
+        Returns:
+            存储中的文件路径
+        """
+        dst_path = self.blob_path(md5)
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+
+        if os.path.exists(dst_path):
+            # 相同内容已存在，丢弃新下载的文件
+            os.remove(src_path)
+            self.touch(md5)
+        else:
+            os.replace(src_path, dst_path)
+            self.touch(md5, os.path.getsize(dst_path))
+
+        if msg_id is not None:
+            self.record(msg_id, title, md5, ext)
+        if alias and alias.lower() != md5.lower():
+            self._append(self._alias_key(alias.lower()), {"alias": alias.lower(), "md5": md5.lower()})
+        return dst_path
+
+    def record(self, msg_id, title: str, md5: str, ext: str = ""):
+        """写入 (msg_id, title) 到文件的索引"""
+        entry = {"msg_id": str(msg_id), "title": title or "", "md5": md5.lower(), "ext": self.normalize_ext(ext)}
+        self._append(self._key(entry["msg_id"], entry["title"]), entry)
+
+    def _append(self, key: str, entry: Dict[str, str]):
+        """更新索引记录并追加到索引文件"""
+        with self._lock:
+            if self._index.get(key) == entry:
+                return
+            if self._set_entry(key, entry):
+                self._stale += 1
+            try:
+                with open(self.index_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except Exception as e:
+                logger.error(f"写入媒体索引失败: {e}")
+
+    def touch(self, md5: str, size: int = None):
+        """记录一次访问，size不为空时表示新增的文件"""
+        md5 = md5.lower()
+        now = time.time()
+        with self._lock:
+            usage = self._usage.get(md5)
+            if usage is None:
+                if size is None:
+                    try:
+                        size = os.path.getsize(self.blob_path(md5))
+                    except OSError:
+                        return
+                self._usage[md5] = [size, now]
+                self._total_bytes += size
+            else:
+                usage[1] = now
+                self._usage.move_to_end(md5)
+
+    def pin(self, md5s: Iterable[str]):
+        """固定文件，不参与淘汰"""
+        with self._lock:
+            self._pinned.update(md5.lower() for md5 in md5s if md5)
+
+    def unpin(self, md5s: Iterable[str]):
+        with self._lock:
+            self._pinned.difference_update(md5.lower() for md5 in md5s if md5)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def scan(self):
+        """
+        启动时扫描一次已有文件，按文件的访问/修改时间建立访问顺序
+
+        扫描期间新写入或访问的文件已经在记录中，保持在最近访问的一端。
+        """
+        found = []
+        for entry in _scan_blobs(self.blob_dir):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            found.append((max(stat.st_atime, stat.st_mtime), entry.name, stat.st_size))
+        found.sort()
+
+        with self._lock:
+            recent = self._usage
+            self._usage = OrderedDict()
+            self._total_bytes = 0
+            for atime, md5, size in found:
+                if md5 not in recent:
+                    self._usage[md5] = [size, atime]
+                    self._total_bytes += size
+            for md5, usage in recent.items():
+                self._usage[md5] = usage
+                self._total_bytes += usage[0]
+            self._scanned = True
+            # 文件已经不存在的索引记录
+            for md5 in [md5 for md5 in self._md5_keys if md5 not in self._usage]:
+                self._stale += self._drop_md5(md5)
+        logger.info(f"媒体存储共 {len(self._usage)} 个文件，{self._total_bytes / 1024 / 1024:.1f} MB")
+
+    def evict(self, max_bytes: int, max_age: float, limit: int) -> int:
+        """
+        从最久未访问的文件开始淘汰，直到总大小不超过max_bytes且没有超过max_age未访问的文件
+
+        每次最多检查limit个文件，剩余的留到下次，避免长时间占用锁。
+        max_bytes或max_age为0时不限制。
+
+        Returns:
+            删除的文件数
+        """
+        now = time.time()
+        removed = []
+        with self._lock:
+            if not self._scanned:
+                return 0
+            for _ in range(min(limit, len(self._usage))):
+                md5, (size, atime) = next(iter(self._usage.items()))
+                over_quota = max_bytes and self._total_bytes > max_bytes
+                expired = max_age and now - atime > max_age
+                if not over_quota and not expired:
+                    break
+                if md5 in self._pinned:
+                    # 固定的文件移到末尾，不再重复检查
+                    self._usage.move_to_end(md5)
+                    continue
+                del self._usage[md5]
+                self._total_bytes -= size
+                self._stale += self._drop_md5(md5)
+                removed.append(md5)
+
+        for md5 in removed:
+            try:
+                os.remove(self.blob_path(md5))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"删除媒体文件失败: {md5}, {e}")
+        if removed:
+            logger.info(f"媒体存储淘汰 {len(removed)} 个文件，剩余 {self._total_bytes / 1024 / 1024:.1f} MB")
+        return len(removed)
+
+    def compact(self, force: bool = False) -> bool:
+        """
+        无效的索引记录足够多时，只用有效记录原子地重写索引文件
+
+        Returns:
+            是否重写了索引文件
+        """
+        with self._lock:
+            if not force and (self._stale < self.COMPACT_MIN or self._stale < len(self._index)):
+                return False
+            # 持有锁写入，避免与追加的记录交错
+            data = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in self._index.values())
+            try:
+                atomic_write(self.index_path, data)
+            except Exception as e:
+                logger.error(f"重写媒体索引失败: {e}")
+                return False
+            logger.info(f"媒体索引已重写，删除 {self._stale} 条无效记录，保留 {len(self._index)} 条")
+            self._stale = 0
+            return True
+
+
+def _scan_blobs(blob_dir: str):
+    """遍历 blobs/ab/cd/ 下的文件"""
+    for first in _scandir(blob_dir):
+        if not first.is_dir():
+            continue
+        for second in _scandir(first.path):
+            if not second.is_dir():
+                continue
+            for entry in _scandir(second.path):
+                if entry.is_file():
+                    yield entry
+
+
+def _scandir(path: str):
+    try:
+        with os.scandir(path) as it:
+            yield from it
+    except OSError:
+        return
+
+
+class MediaCacheJanitor:
+    """后台线程：按配置定期淘汰媒体存储中的文件"""
+
+    def __init__(self, store: MediaStore):
+        self.store = store
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            self.store.scan()
+        except Exception as e:
+            logger.error(f"[MediaCacheJanitor] 扫描媒体存储失败: {e}")
+            return
+
+        while not self._stop_event.is_set():
+            cache_cfg = config.cfg.media_cache
+            removed = 0
+            try:
+                removed = self.store.evict(cache_cfg.max_mb * 1024 * 1024,
+                                           cache_cfg.max_age_days * 86400,
+                                           cache_cfg.evict_batch)
+            except Exception as e:
+                logger.error(f"[MediaCacheJanitor] 错误: {e}")
+            self.store.compact()
+            # 一次没有淘汰完时尽快继续
+            self._stop_event.wait(1 if removed >= cache_cfg.evict_batch else cache_cfg.interval)
+
+    def start(self):
+        """启动淘汰线程"""
+        if not config.cfg.media_cache.enable:
+            return
+        self._thread.start()
+        logger.info(f"[MediaCacheJanitor] 开始管理媒体存储: {self.store.root}")
+
+    def stop(self):
+        """停止淘汰线程"""
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+
+# 创建全局实例
+media_store = MediaStore()
+media_cache_janitor = MediaCacheJanitor(media_store)
@@ -11,10 +11,11 @@ from loguru import logger
 
 import config
 import httpapi
-from api import wechat_contacts, wechat_tenpay
+from api import wechat_api, wechat_contacts, wechat_tenpay
 from config import LOCALE as locale
 from utils import message_formatter, caichengyu, call_wechat_api, filehelper
-from utils.contact_manager import contact_manager
+from utils.avatar_cache import avatar_cache
+from utils.contact_manager import ContactSnapshot, contact_manager
 from utils.group_manager import group_manager
 
 black_list = ['open_chat', 'bizlivenotify', 'qy_chat_update', 74, 'paymsg']
@@ -42,18 +43,27 @@ def extract_message(data):
         return None
 
 
-async def _get_contact_info(wxid: str, content: dict, push_content: str) -> tuple:
-    """获取联系人显示信息，处理特殊情况"""
+async def _get_contact_info(contacts: ContactSnapshot, wxid: str, content: dict, push_content: str) -> tuple:
+    """
+    获取联系人显示信息，处理特殊情况
+
+    Returns:
+        (联系人名称, 头像URL, 头像本地路径)，头像未缓存时本地路径为None
+    """
     # 先读取已保存的联系人
-    contact_saved = await contact_manager.get_contact(wxid)
+    contact_saved = contacts.get(wxid)
     if contact_saved:
         contact_name = contact_saved["name"]
         avatar_url = contact_saved["avatarLink"]
     else:
-        # 异步获取联系人信息
-        user_info = await wechat_contacts.get_user_info(wxid)
-        contact_name = user_info.name
-        avatar_url = user_info.avatar_url
+        # 异步获取联系人信息（并发查询会被合并为批量请求）
+        user_info = await wechat_contacts.load_user_info(wxid)
+        if user_info:
+            contact_name = user_info.name
+            avatar_url = user_info.avatar_url
+        else:
+            contact_name = f"微信_{wxid}"
+            avatar_url = ""
 
     # 从推送内容获取用户名称
     if (contact_name.startswith('微信_') or contact_name.startswith('企微_')) and push_content:
@@ -69,14 +79,17 @@ async def _get_contact_info(wxid: str, content: dict, push_content: str) -> tupl
                 ''
         )
 
-    return contact_name, avatar_url
+    # 头像未缓存时在后台下载
+    avatar_path = avatar_cache.resolve(wxid, avatar_url)
 
+    return contact_name, avatar_url, avatar_path
 
-async def _get_sender_info(from_wxid: str, sender_wxid: str, contact_name: str = "") -> str:
+
+async def _get_sender_info(contacts: ContactSnapshot, from_wxid: str, sender_wxid: str, contact_name: str = "") -> str:
     if sender_wxid == from_wxid:  # 私聊
         sender_name = contact_name
     else:  # 群聊
-        contact_saved = await contact_manager.get_contact(sender_wxid)
+        contact_saved = contacts.get(sender_wxid)
         if contact_saved:
             sender_name = contact_saved["name"]
         else:
@@ -87,10 +100,10 @@ async def _get_sender_info(from_wxid: str, sender_wxid: str, contact_name: str =
     return sender_name
 
 
-async def _get_chat(from_wxid: str) -> Optional[int]:
+async def _get_chat(contacts: ContactSnapshot, from_wxid: str) -> Optional[int]:
     """获取或创建聊天群组"""
     # 读取contact映射
-    contact_dic = await contact_manager.get_contact(from_wxid)
+    contact_dic = contacts.get(from_wxid)
 
     if contact_dic and not contact_dic["isReceive"]:
         return None
@@ -177,10 +190,12 @@ async def _process_message_async(message_info: Dict[str, Any]) -> None:
             return
 
         # ========== 获取联系人和发送者信息 ==========
+        # 处理这条消息期间使用同一个联系人快照
+        contacts = contact_manager.snapshot()
         # 获取联系人信息
-        contact_name, avatar_url = await _get_contact_info(from_wxid, content, push_content)
+        contact_name, avatar_url, avatar_path = await _get_contact_info(contacts, from_wxid, content, push_content)
         # 获取发送者信息
-        sender_name = await _get_sender_info(from_wxid, sender_wxid, contact_name)
+        sender_name = await _get_sender_info(contacts, from_wxid, sender_wxid, contact_name)
 
         # 打印日志过滤掉公众号链接信息
         if not (locale.type(msg_type) == "链接" and from_wxid.startswith('gh_')):
@@ -214,13 +229,13 @@ async def _process_message_async(message_info: Dict[str, Any]) -> None:
                 await caichengyu.handle_image(msg_id, from_wxid, content)
 
         # 获取群组
-        chat_id = await _get_chat(from_wxid)
+        chat_id = await _get_chat(contacts, from_wxid)
         if not chat_id:
             return
 
         # ========== 设置发送者显示格式 ==========
         # 获取联系人信息用于显示
-        contact_dic = await contact_manager.get_contact(from_wxid)
+        contact_dic = contacts.get(from_wxid)
 
         # 设置发送者显示名称
         if "chatroom" in from_wxid or contact_dic["isGroup"]:
@@ -267,6 +282,8 @@ class MessageProcessor:
                 self.loop.run_forever()
             except Exception as e:
                 logger.error(f"消息处理器事件循环异常: {e}")
+            finally:
+                self.loop.close()
 
         thread = threading.Thread(target=run_async, daemon=True)
         thread.start()
@@ -326,6 +343,14 @@ class MessageProcessor:
 
     async def shutdown(self):
         """优雅关闭处理器"""
+        if not self.loop or not self.loop.is_running():
+            return
+        if asyncio.get_running_loop() is not self.loop:
+            # 跨线程调用，在处理器的事件循环中关闭
+            future = asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+            await asyncio.wrap_future(future)
+            return
+
         logger.info("正在关闭消息处理器...")
         self._shutdown = True
 
@@ -343,8 +368,11 @@ class MessageProcessor:
             except asyncio.CancelledError:
                 pass
 
-        if self.loop and self.loop.is_running():
-            self.loop.call_soon_threadsafe(self.loop.stop)
+        # 关闭本事件循环的网关和头像下载连接
+        await wechat_api.close_session()
+        await avatar_cache.close()
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
         logger.info("消息处理器已关闭")
 
@@ -1,13 +1,18 @@
 import asyncio
 import json
+import signal
 import time
 from typing import Any, Dict, Set
 
 from aiohttp import web
 from loguru import logger
 
+import config
+from api import wechat_api, wechat_contacts, wechat_download
 from config import WXID, PORT
-from wechat_handler import process_callback_message
+from utils.avatar_cache import avatar_cache
+from utils.contact_manager import contact_manager
+from wechat_handler import message_processor, process_callback_message
 
 
 class MessageDeduplicator:
@@ -208,9 +213,28 @@ async def create_app():
 
     app.router.add_get("/health", health_check)
 
+    # 网关调用统计，默认Prometheus文本格式，?format=json 返回JSON
+    async def metrics(request):
+        if request.query.get("format") == "json":
+            return web.json_response({
+                "api": wechat_api.get_api_metrics(),
+                "coalesce": wechat_api.get_coalesce_stats(),
+                "download": wechat_download.download_manager.get_stats(),
+            })
+        return web.Response(text=wechat_api.api_metrics.export_prometheus(), content_type="text/plain")
+
+    app.router.add_get("/metrics", metrics)
+
     return app
 
 
+def _save_state():
+    """写入联系人和缓存中尚未保存的修改"""
+    contact_manager.flush()
+    wechat_contacts.user_info_cache.save()
+    avatar_cache.save()
+
+
 async def run_server():
     """启动异步服务器"""
     try:
@@ -223,6 +247,13 @@ async def run_server():
 
         logger.info(f"✅ 微信消息服务启动, 端口: {PORT}, 路径: /msg/SyncMessage/{WXID}")
 
+        # 额外监听Unix域套接字，供同机部署的网关回调
+        listen_uds = config.cfg.service.listen_uds
+        if listen_uds:
+            uds_site = web.UnixSite(runner, listen_uds)
+            await uds_site.start()
+            logger.info(f"✅ 微信消息服务监听Unix域套接字: {listen_uds}")
+
         # 保持服务运行
         try:
             while True:
@@ -231,6 +262,11 @@ async def run_server():
             logger.info("⚠️ 服务正在关闭...")
         finally:
             await runner.cleanup()
+            await message_processor.shutdown()
+            await wechat_api.close_session()
+            await avatar_cache.close()
+            # 写入还在延迟写入窗口中的修改
+            await asyncio.get_running_loop().run_in_executor(None, _save_state)
 
     except OSError as e:
         if e.errno == 48:
@@ -248,6 +284,12 @@ async def main():
         logger.error("❌ PORT 和 WXID 配置不能为空")
         return
 
+    # 收到SIGTERM时取消服务，正常退出以执行清理和atexit中的保存
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        pass
+
     # 启动异步服务器
     await run_server()
 